@@ -0,0 +1,93 @@
+"""
+Local stand-in for the Slack Web API, with configurable latency and rate limiting
+
+Answers chat.postMessage with {"ok": true} after the configured latency, or, for the configured share of calls,
+with 429 and a Retry-After header. Counts every call.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeSlack:
+
+    def __init__(self, latency=0.1, jitter=0.0, rate_limited_ratio=0.0, retry_after=1, seed=None):
+        """Args:
+            :param latency:            (float): Time to answer a call, in seconds.
+            :param jitter:             (float): Random extra latency of up to this many seconds.
+            :param rate_limited_ratio: (float): Share of calls answered with 429, from 0 to 1.
+            :param retry_after:        (float): Value of the Retry-After header of 429 responses, in seconds.
+            :param seed:               (int):   Seed of the random generator, for reproducible runs.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limited_ratio = rate_limited_ratio
+        self.retry_after = retry_after
+        self.calls = 0
+        self.rate_limited = 0
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__server = None
+
+    @property
+    def url(self):
+        """Root URL of the API, to be used as slack.api_url."""
+        host, port = self.__server.server_address
+        return 'http://{0}:{1}/api/'.format(host, port)
+
+    def start(self, host='127.0.0.1', port=0):
+        self.__server = ThreadingHTTPServer((host, port), self.__handler())
+        threading.Thread(target=self.__server.serve_forever, name='fake-slack', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def answer(self):
+        """Counts a call and waits for its latency. Returns True if the call is to be rate limited."""
+        with self.__lock:
+            self.calls += 1
+            limited = self.__random.random() < self.rate_limited_ratio
+            if limited:
+                self.rate_limited += 1
+            delay = self.latency + self.__random.uniform(0, self.jitter)
+        time.sleep(delay)
+        return limited
+
+    def __handler(self):
+        slack = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if slack.answer():
+                    self.__send(429, {'ok': False, 'error': 'ratelimited'}, {'Retry-After': str(slack.retry_after)})
+                else:
+                    self.__send(200, {'ok': True})
+
+            do_GET = do_POST
+
+            def __send(self, status, body, headers=None):
+                body = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
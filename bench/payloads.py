@@ -0,0 +1,181 @@
+"""
+Generates users and realistic GitLab 'Issue Hook' and 'Note Hook' payloads
+
+Payloads carry the same bulky parts as real ones (project, repository, labels, changes) around the handful of
+fields the server reads, with description and comment sizes drawn between the given bounds. A share of the
+events comes from users or projects that aren't in the directory, like on a real GitLab instance.
+"""
+import json
+import random
+
+from consts import *
+
+
+def make_users(count, repo_ratio=0.8):
+    """Args:
+        :param count:      (int):   Number of users.
+        :param repo_ratio: (float): Share of users owning a repository with a webhook.
+
+    Returns:
+        ([dict]): User documents as stored by setup.py.
+    """
+    users = []
+    for i in range(count):
+        user = {
+            KEY_SLACK_UNAME: 'user{0}'.format(i),
+            KEY_SLACK_ID: 'U{0:08d}'.format(i),
+            KEY_GITLAB_UNAME: 'gl-user{0}'.format(i),
+            KEY_GITLAB_USER_ID: i + 1,
+        }
+        if i < count * repo_ratio:
+            user[KEY_GITLAB_REPO_NAME] = 'repo{0}'.format(i)
+            user[KEY_GITLAB_REPO_ID] = 100000 + i
+        users.append(user)
+    return users
+
+
+class PayloadGenerator:
+
+    def __init__(self, users, note_ratio=0.7, unknown_ratio=0.05, min_text=50, max_text=5000, seed=None):
+        """Args:
+            :param users:         ([dict]): Users loaded into the directory.
+            :param note_ratio:    (float):  Share of 'Note Hook' events, the rest are 'Issue Hook' events.
+            :param unknown_ratio: (float):  Share of events by users or on projects unknown to the server.
+            :param min_text:      (int):    Minimum length of descriptions and comments.
+            :param max_text:      (int):    Maximum length of descriptions and comments.
+            :param seed:          (int):    Seed of the random generator, for reproducible runs.
+        """
+        self.__users = users
+        self.__owners = [u for u in users if KEY_GITLAB_REPO_ID in u]
+        self.__note_ratio = note_ratio
+        self.__unknown_ratio = unknown_ratio
+        self.__min_text = min_text
+        self.__max_text = max_text
+        self.__random = random.Random(seed)
+        self.__next_id = 1
+
+    def next(self):
+        """Returns:
+                (str):   GitLab event type.
+                (bytes): JSON body.
+        """
+        if self.__random.random() < self.__note_ratio:
+            return GITLAB_EVENT_NOTE, json.dumps(self.__note()).encode('utf-8')
+        return GITLAB_EVENT_ISSUE, json.dumps(self.__issue()).encode('utf-8')
+
+    def __issue(self):
+        owner, author = self.__parties()
+        issue = self.__issue_attributes(owner, author)
+        return {
+            'object_kind': 'issue',
+            'user': self.__user(author),
+            'project': self.__project(owner),
+            'repository': self.__repository(owner),
+            'object_attributes': issue,
+            'assignees': [self.__user(owner)],
+            'labels': self.__labels(),
+            'changes': {
+                'updated_at': {'previous': '2018-01-01 00:00:00 UTC', 'current': issue['updated_at']},
+                'labels': {'previous': [], 'current': self.__labels()},
+            },
+        }
+
+    def __note(self):
+        owner, author = self.__parties()
+        issue_author = self.__random.choice(self.__users)
+        note_id = self.__new_id()
+        url = 'https://gitlab.example.com/{0}/issues/1#note_{1}'.format(self.__path(owner), note_id)
+        return {
+            'object_kind': 'note',
+            'user': self.__user(author),
+            'project_id': owner.get(KEY_GITLAB_REPO_ID),
+            'project': self.__project(owner),
+            'repository': self.__repository(owner),
+            'object_attributes': {
+                'id': note_id, 'note': self.__text(), 'noteable_type': 'Issue', 'author_id': author[KEY_GITLAB_USER_ID],
+                'created_at': self.__timestamp(), 'updated_at': self.__timestamp(),
+                'project_id': owner.get(KEY_GITLAB_REPO_ID), 'attachment': None, 'line_code': None,
+                'commit_id': '', 'noteable_id': 1, 'system': False, 'st_diff': None, 'url': url,
+            },
+            'issue': self.__issue_attributes(owner, issue_author),
+        }
+
+    def __parties(self):
+        owner = self.__random.choice(self.__owners)
+        author = self.__random.choice(self.__users)
+        if self.__random.random() < self.__unknown_ratio:
+            if self.__random.random() < 0.5:
+                owner = {**owner, KEY_GITLAB_REPO_ID: 900000 + self.__random.randrange(1000)}
+            else:
+                author = {**author, KEY_GITLAB_UNAME: 'stranger{0}'.format(self.__random.randrange(1000))}
+        return owner, author
+
+    def __issue_attributes(self, owner, author):
+        issue_id = self.__new_id()
+        return {
+            'id': issue_id, 'iid': issue_id % 1000, 'title': 'Issue {0}: {1}'.format(issue_id, self.__text(10, 80)),
+            'description': self.__text(), 'state': 'opened', 'author_id': author[KEY_GITLAB_USER_ID],
+            'assignee_ids': [owner[KEY_GITLAB_USER_ID]], 'assignee_id': owner[KEY_GITLAB_USER_ID],
+            'project_id': owner.get(KEY_GITLAB_REPO_ID), 'created_at': self.__timestamp(),
+            'updated_at': self.__timestamp(), 'milestone_id': None, 'confidential': False, 'weight': None,
+            'url': 'https://gitlab.example.com/{0}/issues/{1}'.format(self.__path(owner), issue_id % 1000),
+            'action': 'open',
+        }
+
+    def __user(self, user):
+        return {'name': user[KEY_SLACK_UNAME].title(), 'username': user[KEY_GITLAB_UNAME],
+                'avatar_url': 'https://gitlab.example.com/uploads/user/avatar/1/avatar.png'}
+
+    def __project(self, owner):
+        path = self.__path(owner)
+        return {
+            'id': owner.get(KEY_GITLAB_REPO_ID), 'name': owner.get(KEY_GITLAB_REPO_NAME),
+            'description': self.__text(20, 300), 'web_url': 'https://gitlab.example.com/' + path,
+            'avatar_url': None, 'git_ssh_url': 'git@gitlab.example.com:{0}.git'.format(path),
+            'git_http_url': 'https://gitlab.example.com/{0}.git'.format(path), 'namespace': owner[KEY_GITLAB_UNAME],
+            'visibility_level': 0, 'path_with_namespace': path, 'default_branch': 'master',
+            'homepage': 'https://gitlab.example.com/' + path, 'url': 'git@gitlab.example.com:{0}.git'.format(path),
+            'ssh_url': 'git@gitlab.example.com:{0}.git'.format(path),
+            'http_url': 'https://gitlab.example.com/{0}.git'.format(path),
+        }
+
+    def __repository(self, owner):
+        path = self.__path(owner)
+        return {'name': owner.get(KEY_GITLAB_REPO_NAME), 'url': 'git@gitlab.example.com:{0}.git'.format(path),
+                'description': '', 'homepage': 'https://gitlab.example.com/' + path}
+
+    def __labels(self):
+        return [{'id': i, 'title': 'label-{0}'.format(i), 'color': '#428bca', 'project_id': None,
+                 'created_at': self.__timestamp(), 'updated_at': self.__timestamp(), 'template': False,
+                 'description': self.__text(0, 100), 'type': 'GroupLabel', 'group_id': 1}
+                for i in range(self.__random.randrange(4))]
+
+    def __text(self, min_length=None, max_length=None):
+        length = self.__random.randint(self.__min_text if min_length is None else min_length,
+                                       self.__max_text if max_length is None else max_length)
+        words = []
+        size = 0
+        while size < length:
+            word = self.__random.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        return ' '.join(words)[:length]
+
+    def __timestamp(self):
+        return '2018-{0:02d}-{1:02d} {2:02d}:{3:02d}:{4:02d} UTC'.format(
+            self.__random.randint(1, 12), self.__random.randint(1, 28), self.__random.randrange(24),
+            self.__random.randrange(60), self.__random.randrange(60))
+
+    def __new_id(self):
+        self.__next_id += 1
+        return self.__next_id
+
+    @staticmethod
+    def __path(owner):
+        return '{0}/{1}'.format(owner[KEY_GITLAB_UNAME], owner.get(KEY_GITLAB_REPO_NAME))
+
+
+WORDS = ('the', 'issue', 'build', 'fails', 'when', 'running', 'tests', 'on', 'master', 'after', 'merge', 'of',
+         'branch', 'please', 'check', 'logs', 'attached', 'below', 'stack', 'trace', 'null', 'pointer', 'in',
+         'handler', 'reproduce', 'with', 'steps', 'expected', 'actual', 'result', ':bug:', 'ü', 'naïve', '🚀',
+         '`code`', '"quoted"', '\\path\\to', 'line\nbreak')
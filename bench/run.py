@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Load test of the webhook server, runnable offline
+
+Starts a fake Slack API, fills the user directory with generated users in place of Mongo, serves src/app.py with
+werkzeug in this process and fires generated GitLab events at it from concurrent keep-alive connections. Once every
+Slack message has been delivered, reports webhook latency percentiles, throughput and Slack calls per event.
+
+Example usage (from the root of the repository):
+    python3 bench/run.py --events 5000 --concurrency 16 --users 500 --slack-latency 0.05 --slack-429-ratio 0.01
+
+Everything runs in a temporary directory with its own app.config.yaml, so the local configuration, journal and
+dedup files are left alone.
+"""
+import argparse
+import http.client
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import yaml
+
+from fake_slack import FakeSlack
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Load test of the webhook server against a fake Slack API.')
+    parser.add_argument('--events', type=int, default=2000, help='Number of webhook events to send')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent GitLab connections')
+    parser.add_argument('--users', type=int, default=200, help='Number of users in the directory')
+    parser.add_argument('--note-ratio', type=float, default=0.7, help='Share of comment events, the rest are issues')
+    parser.add_argument('--unknown-ratio', type=float, default=0.05,
+                        help='Share of events by users or on projects the server doesn\'t know')
+    parser.add_argument('--max-text', type=int, default=5000, help='Maximum length of descriptions and comments')
+    parser.add_argument('--slack-latency', type=float, default=0.05, help='Latency of Slack calls, in seconds')
+    parser.add_argument('--slack-jitter', type=float, default=0.02, help='Random extra latency, in seconds')
+    parser.add_argument('--slack-429-ratio', type=float, default=0.0, help='Share of Slack calls answered with 429')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of 429 responses, in seconds')
+    parser.add_argument('--workers', type=int, default=4, help='Number of Slack delivery threads')
+    parser.add_argument('--coalesce', type=float, default=0, help='Comment coalescing window, in seconds')
+    parser.add_argument('--no-journal', action='store_true', help='Disable the notification journal')
+    parser.add_argument('--single-threaded', action='store_true', help='Serve webhooks from a single thread')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the generated data')
+    return parser.parse_args()
+
+
+def write_config(workdir, args, slack_url):
+    with open(os.path.join(ROOT, 'template_app.config.yaml')) as f:
+        settings = yaml.safe_load(f)
+    settings['server']['port'] = 0
+    settings['logging']['level'] = 'ERROR'
+    settings['reload']['watch_interval'] = 0
+    settings['logging']['format'] = 'text'
+    settings['logging']['levels'] = {'werkzeug': 'ERROR'}
+    settings['queue']['size'] = max(settings['queue']['size'], args.events * 3)
+    settings['queue']['workers'] = args.workers
+    settings['coalesce']['window'] = args.coalesce
+    settings['journal']['path'] = '' if args.no_journal else os.path.join(workdir, 'journal.sqlite3')
+    settings['slack']['auth_token'] = 'xoxb-bench'
+    settings['slack']['api_url'] = slack_url
+    with open(os.path.join(workdir, 'app.config.yaml'), 'w') as f:
+        yaml.safe_dump(settings, f, default_flow_style=False)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def main():
+    args = parse_args()
+    slack = FakeSlack(args.slack_latency, args.slack_jitter, args.slack_429_ratio, args.retry_after, args.seed)
+    slack.start()
+
+    workdir = tempfile.mkdtemp(prefix='butler-bench-')
+    write_config(workdir, args, slack.url)
+    os.environ['BUTLER_CONFIG'] = os.path.join(workdir, 'app.config.yaml')
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+    from werkzeug.serving import make_server
+    import app
+    from payloads import make_users, PayloadGenerator
+    from utils import UserDirectory
+
+    users = make_users(args.users)
+    app.user_directory = UserDirectory()
+    app.user_directory.replace(users)
+    app.start_journal()
+    app.start_delivery_queue()
+    app.start_coalescer()
+
+    generator = PayloadGenerator(users, args.note_ratio, args.unknown_ratio, max_text=args.max_text,
+                                 seed=args.seed)
+    events = [generator.next() for _ in range(args.events)]
+    body_size = sum(len(body) for _, body in events) / max(1, len(events))
+
+    server = make_server('127.0.0.1', 0, app.app, threaded=not args.single_threaded)
+    threading.Thread(target=server.serve_forever, name='webhook', daemon=True).start()
+    host, port = server.server_address
+
+    local = threading.local()
+
+    def send(event):
+        event_type, body = event
+        if not hasattr(local, 'connection'):
+            local.connection = http.client.HTTPConnection(host, port)
+        start = time.perf_counter()
+        try:
+            local.connection.request('POST', '/', body, {'Content-Type': 'application/json',
+                                                         'X-Gitlab-Event': event_type})
+            response = local.connection.getresponse()
+            response.read()
+            status = response.status
+        except (http.client.HTTPException, OSError):
+            local.connection.close()
+            del local.connection
+            status = 'error'
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        results = list(executor.map(send, events))
+    accepted = time.perf_counter() - start
+    while app.coalescer and app.coalescer.pending():
+        time.sleep(0.1)
+    # A flushed batch may still be on its way into the queue
+    time.sleep(0.1 if app.coalescer else 0)
+    app.delivery_queue.join()
+    delivered = time.perf_counter() - start
+    server.shutdown()
+    slack.stop()
+
+    latencies = sorted(latency for latency, _ in results)
+    statuses = {}
+    for _, status in results:
+        statuses[status] = statuses.get(status, 0) + 1
+
+    print('Events:              {0} ({1:.0f} bytes on average)'.format(len(events), body_size))
+    print('Responses:           {0}'.format(', '.join('{0}: {1}'.format(s, n) for s, n in sorted(
+        statuses.items(), key=lambda item: str(item[0])))))
+    print('Webhook throughput:  {0:.1f} events/s'.format(len(events) / accepted))
+    print('Webhook latency:     p50 {0:.2f} ms, p95 {1:.2f} ms, p99 {2:.2f} ms, max {3:.2f} ms'.format(
+        *(1000 * percentile(latencies, f) for f in (0.5, 0.95, 0.99, 1))))
+    print('Delivery throughput: {0:.1f} events/s ({1:.2f} s until the last Slack message)'.format(
+        len(events) / delivered, delivered))
+    print('Slack calls:         {0} ({1} rate limited), {2:.2f} per event'.format(
+        slack.calls, slack.rate_limited, slack.calls / max(1, len(events))))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,152 +1,211 @@
 #!/usr/bin/env python3
-from flask import Flask, request
+import threading
+
+from flask import Flask, Response, request
 from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
-from requests import post
+from werkzeug.exceptions import HTTPException
 from consts import *
-from utils import error, warning
+from consts.config import add_config_listener
+from events import EVENT_HANDLERS, EVENT_FIELDS, combine_note_messages, note_batch_key
+from utils import error, info, warning, delivery_key, extract_fields, Coalescer, ConfigWatcher, DedupCache, \
+    DeliveryQueue, Journal, RetryLater, SlackClient, UserDirectory
+from utils.metrics import CONTENT_TYPE, QUEUE_DEPTH, REGISTRY, STAGE_SECONDS, WEBHOOK_REQUESTS
 
 
 app = Flask(__name__)
-user_collection = None
-
-SLACK_REQUESTS_HEADER = {**{'Content-type': 'application/json'}, **SLACK_AUTH_HEADER}
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY_SIZE
+user_directory = None
+delivery_queue = None
+slack_client = None
+journal = None
+coalescer = None
+dedup_cache = DedupCache()
 
 
 def start_mongo():
     try:
         client = MongoClient(MONGO_ADDRESS, MONGO_PORT, serverSelectionTimeoutMS=10)
-        global user_collection
-        user_collection = client.iax058x.users
+        global user_directory
+        user_directory = UserDirectory(client.iax058x.users, client.iax058x.meta)
+        user_directory.start()
     except ServerSelectionTimeoutError:
         error('Mongo timeout. '
               'Make sure Mongo server is running and the port number is same as in the configuration file!')
         exit(1)
 
 
-@app.route('/', methods=['GET'])
-def ping():
-    return '', 200
-
+def start_delivery_queue():
+    global delivery_queue, slack_client
+    slack_client = SlackClient(SLACK_AUTH_HEADER, pool_size=QUEUE_WORKERS)
+    delivery_queue = DeliveryQueue(post_slack_message, QUEUE_SIZE, QUEUE_WORKERS, QUEUE_PRIORITIES)
+    delivery_queue.start()
+    QUEUE_DEPTH.set_function(delivery_queue.depth)
+    if journal:
+        threading.Thread(target=replay_journal, name='journal-replay', daemon=True).start()
 
-@app.route('/', methods=['POST'])
-def gitlab_post_hook():
-    payload = request.get_json()
-    event_type = request.headers.get('X-Gitlab-Event')
 
-    if payload is None or event_type not in SUPPORTED_GITLAB_EVENTS:
-        return '', 400
-    if event_type == GITLAB_EVENT_ISSUE:
-        return issue_event(payload)
-    if event_type == GITLAB_EVENT_NOTE:
-        return note_event(payload)
+def start_journal():
+    if not JOURNAL_PATH:
+        return
+    global journal
+    journal = Journal(JOURNAL_PATH)
+    journal.start()
 
 
-def issue_event(payload):
-    user = get_user(payload)
-    author = get_author(payload)
-    issue = get_issue(payload)
+def start_coalescer():
+    if not COALESCE_WINDOW:
+        return
+    global coalescer
+    coalescer = Coalescer(flush_note_messages, COALESCE_WINDOW, COALESCE_MAX_DELAY)
+    coalescer.start()
 
-    if not user: return '', 400
-    if not author: author = {}
 
-    attachment_for_user = {
-        **new_attachment(ISSUE_MSG_TO_USER, "Assigned by", '@' + author.get(KEY_SLACK_UNAME)),
-        **issue}
+def start_config_watcher():
+    add_config_listener(apply_config)
+    ConfigWatcher(CONFIG_PATH, CONFIG_WATCH_INTERVAL).start()
 
-    attachment_for_author = {
-        **new_attachment(ISSUE_MSG_TO_AUTHOR, "Assigned to", '@' + user.get(KEY_SLACK_UNAME)),
-        **issue}
 
-    msg_to_user = new_slack_message(user.get(KEY_SLACK_ID), attachment=attachment_for_user)
-    msg_to_author = new_slack_message(author.get(KEY_SLACK_ID), attachment=attachment_for_author)
+def apply_config(config):
+    if slack_client:
+        slack_client.configure(config.slack_auth_header, config.request_timeout, config.slack_max_retries,
+                               config.slack_retry_backoff)
+    if delivery_queue:
+        delivery_queue.set_weights(config.queue_priorities)
 
-    post(SLACK_POST_MESSAGE_URL, json=msg_to_user, headers=SLACK_REQUESTS_HEADER)
-    if author.get(KEY_SLACK_ID):
-        post(SLACK_POST_MESSAGE_URL, json=msg_to_author, headers=SLACK_REQUESTS_HEADER)
 
-    return '', 200
+def replay_journal():
+    count = 0
+    for entry_id, message, event_type in journal.pending():
+        delivery_queue.put((entry_id, message), block=True, priority=event_type)
+        count += 1
+    if count:
+        info('Replayed {0} pending messages from the journal.'.format(count))
 
 
-def note_event(payload):
-    issue_owner = mongo_find_one({KEY_GITLAB_USER_ID: payload.get('issue', {}).get('author_id', '')})
-    comment_author = get_author(payload)
-    repo_owner = get_user(payload)
-    note = get_note(payload)
-
-    notify_repo_owner = repo_owner != issue_owner and repo_owner != comment_author
-    notify_issue_owner = issue_owner != comment_author
-
-    attachment = {
-        **new_attachment(NOTE_MSG_TO_ALL, "Commented by", '@' + comment_author.get(KEY_SLACK_UNAME)),
-        **note}
-
-    msg_to_issue_owner = new_slack_message(issue_owner.get(KEY_SLACK_ID), attachment=attachment)
-    msg_to_repo_owner = new_slack_message(repo_owner.get(KEY_SLACK_ID), attachment=attachment)
-
-    if notify_issue_owner:
-        post(SLACK_POST_MESSAGE_URL, json=msg_to_issue_owner, headers=SLACK_REQUESTS_HEADER)
-    if notify_repo_owner:
-        post(SLACK_POST_MESSAGE_URL, json=msg_to_repo_owner, headers=SLACK_REQUESTS_HEADER)
-
+@app.route('/', methods=['GET'])
+def ping():
     return '', 200
 
 
-def mongo_find_one(param):
-    try:
-        return user_collection.find_one(param)
-    except ServerSelectionTimeoutError:
-        error('Mongo timeout. '
-              'Make sure Mongo server is running and the port number is same as in the configuration file!')
-
-
-def get_user(payload):
-    oa = payload.get('object_attributes', {})
-    project_id = oa.get('project_id')
-    user = mongo_find_one({KEY_GITLAB_REPO_ID: project_id})
-    if user: return user
-    warning('Received an event for project with id {0}, but can\'t find the owner.'.format(project_id))
-
-
-def get_author(payload):
-    uname = payload.get('user', {}).get('username', "")
-    author = mongo_find_one({KEY_GITLAB_UNAME: uname})
-    if author: return author
-    warning('Can\'t find user {0} in the database'.format(uname))
-
-
-def get_issue(payload):
-    oa = payload.get('object_attributes', {})
-    url = oa.get('url')
-    title = oa.get('title')
-    description = oa.get('description')
-    issue = {}
-    if title: issue["title"] = title
-    if url: issue['title_link'] = url
-    if description: issue["text"] = description
-    return issue
-
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
 
-def get_note(payload):
-    oa = payload.get('object_attributes', {})
-    url = oa.get('url')
-    content = oa.get('note')
-    note = {}
-    note['title'] = 'CLick here for details'
-    if content: note['text'] = content
-    if url: note['title_link'] = url
-    return note
-
-
-def new_attachment(pretext, title, value, color=ISSUE_COLOR):
-    return {"color": color, "pretext": pretext, "fields": [{
-        "title": title, "value": value, "short": "false"}]}
 
+@app.route('/', methods=['POST'])
+def gitlab_post_hook():
+    event_type = request.headers.get(GITLAB_EVENT_HEADER)
+    # Failed requests are counted with the status they are answered with
+    status = 500
+    try:
+        body, status = handle_gitlab_event(event_type)
+        return body, status
+    except HTTPException as e:
+        status = e.code
+        raise
+    finally:
+        WEBHOOK_REQUESTS.inc(event_type if event_type in SUPPORTED_GITLAB_EVENTS else 'unsupported', status)
+
+
+def handle_gitlab_event(event_type):
+    event_uuid = request.headers.get(GITLAB_EVENT_UUID_HEADER)
+    if event_uuid and event_uuid in dedup_cache:
+        # GitLab retry of a delivery we've already handled
+        return '', 200
+    if request.content_length and request.content_length > MAX_BODY_SIZE:
+        return '', 413
+    if event_type not in SUPPORTED_GITLAB_EVENTS:
+        return '', 400
+    try:
+        with STAGE_SECONDS.time('parse'):
+            payload = extract_fields(request.get_data(cache=False), EVENT_FIELDS[event_type], MAX_BODY_SIZE)
+    except ValueError:
+        return '', 400
 
-def new_slack_message(channel_id, attachment=None, as_user=True):
-    return {"channel": channel_id, 'as_user': as_user, "attachments": [attachment]}
+    key = delivery_key(event_type, event_uuid, payload)
+    # Reserved before anything else, so that a concurrent GitLab retry of the delivery isn't handled too
+    if key and not dedup_cache.reserve(key):
+        return '', 200
+    handled = False
+    try:
+        with STAGE_SECONDS.time('handle'):
+            messages = EVENT_HANDLERS[event_type](payload, user_directory)
+        if messages is None:
+            return '', 400
+        buffered = bool(coalescer) and event_type == GITLAB_EVENT_NOTE
+        if buffered:
+            entry_ids = buffer_note_messages(payload, messages)
+        else:
+            send_slack_messages(event_type, messages)
+        # Comments that aren't journaled live in memory only until flushed, let a GitLab retry bring them again
+        handled = not buffered or entry_ids is not None
+        return '', 200
+    finally:
+        if key and handled:
+            dedup_cache.add(key)
+        elif key:
+            dedup_cache.discard(key)
+
+
+def journal_messages(event_type, messages, replaces=None):
+    if not journal:
+        return None
+    with STAGE_SECONDS.time('journal'):
+        return journal.append(event_type, messages, replaces)
+
+
+def send_slack_messages(event_type, messages, replaces=None):
+    entry_ids = journal_messages(event_type, messages, replaces)
+    for entry_id, message in zip(entry_ids or [None] * len(messages), messages):
+        if delivery_queue.put((entry_id, message), priority=event_type):
+            continue
+        if entry_id:
+            warning('Slack delivery queue is full. Message to {0} is kept in the journal until restart.'
+                    .format(message.channel))
+        else:
+            warning('Slack delivery queue is full. Dropping message to {0}.'.format(message.channel))
+
+
+def buffer_note_messages(payload, messages):
+    """Journals the comments and hands them to the coalescer, so that a restart replays what is still buffered.
+
+        Returns:
+            ([str]): Entry ids of the comments, None if they aren't journaled.
+    """
+    entry_ids = journal_messages(GITLAB_EVENT_NOTE, messages)
+    for entry_id, message in zip(entry_ids or [None] * len(messages), messages):
+        coalescer.add(note_batch_key(payload, message), (entry_id, message))
+    return entry_ids
+
+
+def flush_note_messages(items):
+    entry_ids, messages = zip(*items)
+    # The digest takes over the journal entries of the comments it combines
+    send_slack_messages(GITLAB_EVENT_NOTE, [combine_note_messages(list(messages))],
+                        [entry_id for entry_id in entry_ids if entry_id])
+
+
+def post_slack_message(item):
+    entry_id, message = item[:2]
+    # Attempts made so far, carried by items waiting for a retry
+    attempts = item[2] if len(item) > 2 else 0
+    # Don't hold the worker while the channel or Slack asks us to wait, other messages can go meanwhile
+    result = slack_client.post_message(message, wait=False, attempt=attempts + 1)
+    if 'retry_after' in result.data:
+        raise RetryLater(result.data['retry_after'], (entry_id, message, result.attempts))
+    if not result.ok:
+        warning('Couldn\'t deliver message to {0} after {1} attempt(s). Slack returned {2}.'
+                .format(message.channel, result.attempts, result.error))
+    if entry_id:
+        journal.done(entry_id, delivered=result.ok)
+    return result
 
 
 if __name__ == '__main__':
     start_mongo()
+    start_journal()
+    start_delivery_queue()
+    start_coalescer()
+    start_config_watcher()
     app.run(host='0.0.0.0', port=SERVER_PORT)
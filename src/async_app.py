@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+asyncio based webhook server, an alternative to app.py for high event rates.
+
+Serves the same routes and handles events the same way as app.py, but all I/O runs on a single event loop:
+users are loaded with motor and Slack messages are delivered with aiohttp, so concurrent webhook deliveries
+don't need a thread each. Requires aiohttp and motor.
+"""
+import asyncio
+
+from aiohttp import web
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import PyMongoError, ServerSelectionTimeoutError
+
+from consts import *
+from consts.config import add_config_listener
+from events import EVENT_HANDLERS, EVENT_FIELDS, combine_note_messages, note_batch_key
+from utils import error, info, warning, delivery_key, extract_fields, AsyncDeliveryQueue, Coalescer, ConfigWatcher, \
+    DedupCache, Journal, UserDirectory
+from utils.async_slack_client import AsyncSlackClient
+from utils.metrics import CONTENT_TYPE, QUEUE_DEPTH, REGISTRY, STAGE_SECONDS, USER_DIRECTORY_LOAD_SECONDS, \
+    WEBHOOK_REQUESTS
+
+
+user_directory = UserDirectory()
+dedup_cache = DedupCache()
+
+
+async def ping(request):
+    return web.Response(status=200)
+
+
+async def metrics(request):
+    return web.Response(body=REGISTRY.render().encode('utf-8'), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def gitlab_post_hook(request):
+    event_type = request.headers.get(GITLAB_EVENT_HEADER)
+    # Failed requests are counted with the status they are answered with
+    status = 500
+    try:
+        status = await handle_gitlab_event(request, event_type)
+        return web.Response(status=status)
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        WEBHOOK_REQUESTS.inc(event_type if event_type in SUPPORTED_GITLAB_EVENTS else 'unsupported', status)
+
+
+async def handle_gitlab_event(request, event_type):
+    event_uuid = request.headers.get(GITLAB_EVENT_UUID_HEADER)
+    if event_uuid and event_uuid in dedup_cache:
+        # GitLab retry of a delivery we've already handled
+        return 200
+    if request.content_length and request.content_length > MAX_BODY_SIZE:
+        return 413
+    if event_type not in SUPPORTED_GITLAB_EVENTS:
+        return 400
+    body = await request.read()
+    try:
+        with STAGE_SECONDS.time('parse'):
+            payload = extract_fields(body, EVENT_FIELDS[event_type], MAX_BODY_SIZE)
+    except ValueError:
+        return 400
+
+    key = delivery_key(event_type, event_uuid, payload)
+    # Reserved before the first await, so that a concurrent GitLab retry of the delivery isn't handled too
+    if key and not dedup_cache.reserve(key):
+        return 200
+    handled = False
+    try:
+        with STAGE_SECONDS.time('handle'):
+            messages = EVENT_HANDLERS[event_type](payload, user_directory)
+        if messages is None:
+            return 400
+        buffered = bool(request.app['coalescer']) and event_type == GITLAB_EVENT_NOTE
+        if buffered:
+            entry_ids = await buffer_note_messages(request.app, payload, messages)
+        else:
+            await send_slack_messages(request.app, event_type, messages)
+        # Comments that aren't journaled live in memory only until flushed, let a GitLab retry bring them again
+        handled = not buffered or entry_ids is not None
+        return 200
+    finally:
+        if key and handled:
+            dedup_cache.add(key)
+        elif key:
+            dedup_cache.discard(key)
+
+
+async def journal_messages(app, event_type, messages, replaces=None):
+    journal = app['journal']
+    if not journal:
+        return None
+    if not messages:
+        return []
+    # Journal writes block until the batch is synced, keep them off the event loop
+    with STAGE_SECONDS.time('journal'):
+        return await asyncio.get_event_loop().run_in_executor(None, journal.append, event_type, messages, replaces)
+
+
+async def send_slack_messages(app, event_type, messages, replaces=None):
+    entry_ids = await journal_messages(app, event_type, messages, replaces)
+    for entry_id, message in zip(entry_ids or [None] * len(messages), messages):
+        try:
+            app['delivery_queue'].put_nowait((event_type, (entry_id, message)))
+        except asyncio.QueueFull:
+            if entry_id:
+                warning('Slack delivery queue is full. Message to {0} is kept in the journal until restart.'
+                        .format(message.channel))
+            else:
+                warning('Slack delivery queue is full. Dropping message to {0}.'.format(message.channel))
+
+
+async def buffer_note_messages(app, payload, messages):
+    """Journals the comments and hands them to the coalescer, so that a restart replays what is still buffered.
+
+        Returns:
+            ([str]): Entry ids of the comments, None if they aren't journaled.
+    """
+    entry_ids = await journal_messages(app, GITLAB_EVENT_NOTE, messages)
+    for entry_id, message in zip(entry_ids or [None] * len(messages), messages):
+        app['coalescer'].add(note_batch_key(payload, message), (entry_id, message))
+    return entry_ids
+
+
+async def flush_note_messages(app, items):
+    entry_ids, messages = zip(*items)
+    # The digest takes over the journal entries of the comments it combines
+    await send_slack_messages(app, GITLAB_EVENT_NOTE, [combine_note_messages(list(messages))],
+                              [entry_id for entry_id in entry_ids if entry_id])
+
+
+async def replay_journal(journal, delivery_queue):
+    count = 0
+    pending = journal.pending()
+    loop = asyncio.get_event_loop()
+    while True:
+        entry = await loop.run_in_executor(None, next, pending, None)
+        if entry is None:
+            break
+        entry_id, message, event_type = entry
+        await delivery_queue.put((event_type, (entry_id, message)))
+        count += 1
+    if count:
+        info('Replayed {0} pending messages from the journal.'.format(count))
+
+
+async def post_slack_messages(slack_client, delivery_queue, journal):
+    while True:
+        event_type, item = await delivery_queue.get()
+        entry_id, message = item[:2]
+        # Attempts made so far, carried by items waiting for a retry
+        attempts = item[2] if len(item) > 2 else 0
+        deferred = False
+        try:
+            # Don't hold the worker while the channel or Slack asks us to wait, other messages can go meanwhile
+            result = await slack_client.post_message(message, wait=False, attempt=attempts + 1)
+            if 'retry_after' in result.data:
+                delivery_queue.defer((event_type, (entry_id, message, result.attempts)), result.data['retry_after'])
+                deferred = True
+                continue
+            if not result.ok:
+                warning('Couldn\'t deliver message to {0} after {1} attempt(s). Slack returned {2}.'
+                        .format(message.channel, result.attempts, result.error))
+            if entry_id:
+                journal.done(entry_id, delivered=result.ok)
+        except Exception as e:
+            error('Delivery failed: {0}'.format(e))
+        finally:
+            if not deferred:
+                delivery_queue.task_done()
+
+
+async def load_users(db, force=False):
+    stamp = await db.meta.find_one({'_id': KEY_USERS_VERSION})
+    version = stamp.get('version') if stamp else None
+    if force or version != user_directory.version:
+        with USER_DIRECTORY_LOAD_SECONDS.time():
+            users = await db.users.find({}).to_list(None)
+        user_directory.replace(users, version)
+
+
+async def watch_users(db):
+    while True:
+        await asyncio.sleep(USER_DIRECTORY_REFRESH)
+        try:
+            await load_users(db)
+        except PyMongoError as e:
+            error('Couldn\'t refresh the user directory, serving cached users. {0}'.format(e))
+
+
+async def start(app):
+    db = AsyncIOMotorClient(MONGO_ADDRESS, MONGO_PORT, serverSelectionTimeoutMS=10).iax058x
+    try:
+        await load_users(db, force=True)
+    except ServerSelectionTimeoutError:
+        error('Mongo timeout. '
+              'Make sure Mongo server is running and the port number is same as in the configuration file!')
+        exit(1)
+
+    app['journal'] = None
+    if JOURNAL_PATH:
+        app['journal'] = Journal(JOURNAL_PATH)
+        app['journal'].start()
+    app['slack_client'] = AsyncSlackClient(SLACK_AUTH_HEADER, pool_size=QUEUE_WORKERS)
+    app['delivery_queue'] = AsyncDeliveryQueue(QUEUE_SIZE, QUEUE_PRIORITIES)
+    QUEUE_DEPTH.set_function(app['delivery_queue'].depth)
+    app['tasks'] = [asyncio.ensure_future(watch_users(db))] + [
+        asyncio.ensure_future(post_slack_messages(app['slack_client'], app['delivery_queue'], app['journal']))
+        for _ in range(QUEUE_WORKERS)]
+    app['coalescer'] = None
+    if COALESCE_WINDOW:
+        # The coalescer flushes from its own thread, hand the batches back to the event loop
+        loop = asyncio.get_event_loop()
+        app['coalescer'] = Coalescer(
+            lambda items: asyncio.run_coroutine_threadsafe(flush_note_messages(app, items), loop),
+            COALESCE_WINDOW, COALESCE_MAX_DELAY)
+        app['coalescer'].start()
+    if app['journal']:
+        app['tasks'].append(asyncio.ensure_future(replay_journal(app['journal'], app['delivery_queue'])))
+    add_config_listener(lambda config: apply_config(app, config))
+    ConfigWatcher(CONFIG_PATH, CONFIG_WATCH_INTERVAL).start()
+
+
+def apply_config(app, config):
+    app['slack_client'].configure(config.slack_auth_header, config.request_timeout, config.slack_max_retries,
+                                  config.slack_retry_backoff)
+    app['delivery_queue'].set_weights(config.queue_priorities)
+
+
+async def stop(app):
+    for task in app['tasks']:
+        task.cancel()
+    await asyncio.gather(*app['tasks'], return_exceptions=True)
+    await app['slack_client'].close()
+
+
+def create_app():
+    app = web.Application(client_max_size=MAX_BODY_SIZE)
+    app.router.add_get('/', ping)
+    app.router.add_get('/metrics', metrics)
+    app.router.add_post('/', gitlab_post_hook)
+    app.on_startup.append(start)
+    app.on_cleanup.append(stop)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), host='0.0.0.0', port=SERVER_PORT)
@@ -0,0 +1,183 @@
+"""
+Settings that can change while the server runs
+
+Message texts, tokens, timeouts, retries, delivery priorities and log levels are read from a Config snapshot
+rather than from the constants. reload_config() parses and validates app.config.yaml in full, lets the
+registered validators check the result (e.g. compile the message templates), and only then replaces the
+current snapshot. A broken edit therefore leaves the running configuration untouched.
+
+Snapshots are immutable and replaced with a single assignment, so readers don't lock: they call
+current_config() once and use that snapshot for the rest of the operation.
+
+Example usage:
+    config = current_config()
+    requests.get(url, headers=config.gitlab_auth_header, timeout=config.request_timeout)
+
+Everything else (ports, addresses, paths, queue and pool sizes) still needs a restart.
+"""
+import logging
+import threading
+from collections import namedtuple
+
+import yaml
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Config(namedtuple('Config', [
+        'slack_auth_token', 'gitlab_auth_token', 'request_timeout', 'ssl_verify',
+        'slack_max_retries', 'slack_retry_backoff', 'slack_max_text_length', 'slack_templates',
+        'issue_msg_to_user', 'issue_msg_to_author', 'note_msg_to_all',
+        'queue_priorities', 'log_level', 'log_levels'])):
+    __slots__ = ()
+
+    @property
+    def slack_auth_header(self):
+        return {'Authorization': 'Bearer ' + self.slack_auth_token}
+
+    @property
+    def gitlab_auth_header(self):
+        return {'PRIVATE-TOKEN': self.gitlab_auth_token}
+
+
+_REQUIRED = object()
+_current = None
+_validators = []
+_listeners = []
+_reload_lock = threading.Lock()
+
+
+def read_settings(path):
+    """Returns:
+            (dict): Parsed app.config.yaml. The C loader parses it in a fraction of the time of the Python one.
+    """
+    with open(path, "r") as f:
+        return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
+
+
+def parse_config(settings):
+    """Builds a Config from parsed app.config.yaml. Raises ConfigError naming the first invalid setting."""
+    requests = _section(settings, 'requests')
+    slack = _section(settings, 'slack')
+    messages = _section(slack, 'messages', 'slack.messages')
+    queue = _section(settings, 'queue', default={})
+    logs = _section(settings, 'logging', default={})
+
+    # request_timeout is the documented name, timeout the one the constants used to read
+    timeout_key = 'request_timeout' if 'request_timeout' in requests else 'timeout'
+    priorities = _get(queue, 'priorities', dict, 'queue.priorities', {'Issue Hook': 8, 'Note Hook': 1})
+    for event_type, weight in priorities.items():
+        _check(_is_number(weight) and weight > 0, 'queue.priorities.' + str(event_type), 'a positive number')
+    templates = _get(slack, 'templates', dict, 'slack.templates', {})
+    for name, spec in templates.items():
+        _check(isinstance(spec, dict), 'slack.templates.' + str(name), 'a mapping')
+    log_levels = _get(logs, 'levels', dict, 'logging.levels', {})
+    for module, level in log_levels.items():
+        _check(_is_log_level(level), 'logging.levels.' + str(module), 'a log level')
+
+    return Config(
+        slack_auth_token=_get(slack, 'auth_token', str, 'slack.auth_token'),
+        gitlab_auth_token=_get(_section(settings, 'gitlab'), 'auth_token', str, 'gitlab.auth_token'),
+        request_timeout=_get(requests, timeout_key, 'positive', 'requests.' + timeout_key, 10),
+        ssl_verify=_get(requests, 'ssl_verify', bool, 'requests.ssl_verify', True),
+        slack_max_retries=_get(slack, 'max_retries', int, 'slack.max_retries', 3),
+        slack_retry_backoff=_get(slack, 'retry_backoff', 'number', 'slack.retry_backoff', 1.0),
+        slack_max_text_length=_get(slack, 'max_text_length', int, 'slack.max_text_length', 3000),
+        slack_templates=templates,
+        issue_msg_to_user=_get(_section(messages, 'issue', 'slack.messages.issue'), 'to_user', str,
+                               'slack.messages.issue.to_user'),
+        issue_msg_to_author=_get(_section(messages, 'issue', 'slack.messages.issue'), 'to_author', str,
+                                 'slack.messages.issue.to_author'),
+        note_msg_to_all=_get(_section(messages, 'note', 'slack.messages.note'), 'to_all', str,
+                             'slack.messages.note.to_all'),
+        queue_priorities=priorities,
+        log_level=_get(logs, 'level', 'log level', 'logging.level', 'INFO'),
+        log_levels=log_levels,
+    )
+
+
+def current_config():
+    """Returns:
+            (Config): The current snapshot.
+    """
+    return _current
+
+
+def install_config(config):
+    """Makes the config current without validation, for the initial load."""
+    global _current
+    _current = config
+
+
+def reload_config(path):
+    """Reads, validates and installs app.config.yaml, then notifies the listeners.
+
+        Returns:
+            (Config): The new snapshot.
+
+    Raises ConfigError if the file can't be read or is invalid, the current snapshot stays in place then.
+    """
+    with _reload_lock:
+        try:
+            config = parse_config(read_settings(path))
+        except (IOError, yaml.YAMLError) as e:
+            raise ConfigError('Can\'t read {0}: {1}'.format(path, e))
+        for validate in _validators:
+            try:
+                validate(config)
+            except ConfigError:
+                raise
+            except Exception as e:
+                raise ConfigError(str(e))
+        install_config(config)
+        for listener in _listeners:
+            listener(config)
+        return config
+
+
+def add_config_validator(validate):
+    """Registers a callable that raises if a new Config can't be used. Runs before the Config is installed."""
+    _validators.append(validate)
+
+
+def add_config_listener(listener):
+    """Registers a callable that is given every new Config once it's installed."""
+    _listeners.append(listener)
+
+
+def _section(settings, key, name=None, default=_REQUIRED):
+    return _get(settings, key, dict, name or key, default)
+
+
+def _get(settings, key, kind, name, default=_REQUIRED):
+    value = settings.get(key) if isinstance(settings, dict) else None
+    if value is None:
+        _check(default is not _REQUIRED, name, 'set')
+        return default
+    if kind == 'number':
+        _check(_is_number(value) and value >= 0, name, 'a non-negative number')
+    elif kind == 'positive':
+        _check(_is_number(value) and value > 0, name, 'a positive number')
+    elif kind == 'log level':
+        _check(_is_log_level(value), name, 'a log level')
+    elif kind is int:
+        _check(isinstance(value, int) and not isinstance(value, bool) and value >= 0, name,
+               'a non-negative integer')
+    else:
+        _check(isinstance(value, kind), name, 'a ' + {str: 'string', bool: 'boolean', dict: 'mapping'}[kind])
+    return value
+
+
+def _check(condition, name, expected):
+    if not condition:
+        raise ConfigError('{0} must be {1}'.format(name, expected))
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_log_level(value):
+    return isinstance(logging.getLevelName(str(value).upper()), int)
@@ -1,24 +1,87 @@
 """
 NB! Don't touch this unless you know what you're doing!
 """
-import yaml
-import os.path
+import os
 
+from .config import install_config, parse_config, read_settings
 
-path = os.path.abspath("app.config.yaml")
+
+# app.config.yaml in the root of the project, wherever the process is started from, unless BUTLER_CONFIG says
+# otherwise
+path = os.path.abspath(os.environ.get('BUTLER_CONFIG') or
+                       os.path.join(os.path.dirname(__file__), os.pardir, os.pardir, 'app.config.yaml'))
 print(path)
 
-with open(path, "r") as f:
-    settings = yaml.load(f)
+CONFIG_PATH = path
+settings = read_settings(path)
+# Reloadable settings, see config.py. The constants below hold their values at startup
+__config = parse_config(settings)
+install_config(__config)
 
 SERVER_PORT = settings['server']['port']
+MAX_BODY_SIZE = settings['server'].get('max_body_size', 1024 * 1024)
 MONGO_PORT = settings['mongo']['port']
 MONGO_ADDRESS = settings['mongo']['address']
+USER_DIRECTORY_REFRESH = settings['mongo'].get('directory_refresh', 10)
 SERVER_ADDRESS = settings['server']['address'] + ":" + str(settings['server']['port'])
-SSL_VERIFY = settings['requests']['ssl_verify']
-REQUEST_TIMEOUT = settings['requests']['timeout']
+SSL_VERIFY = __config.ssl_verify
+REQUEST_TIMEOUT = __config.request_timeout
 DATA_FROM = settings['data']['from']
 
+'''
+Logging
+'''
+LOG_FORMAT = settings.get('logging', {}).get('format', 'auto')
+LOG_LEVEL = __config.log_level
+LOG_LEVELS = __config.log_levels
+LOG_RATE_LIMIT = settings.get('logging', {}).get('rate_limit', 10)
+LOG_RATE_INTERVAL = settings.get('logging', {}).get('rate_interval', 60)
+
+'''
+Slack delivery queue
+'''
+QUEUE_SIZE = settings.get('queue', {}).get('size', 1000)
+QUEUE_WORKERS = settings.get('queue', {}).get('workers', 4)
+# Scheduling weights by GitLab event type, event types not listed have weight 1
+QUEUE_PRIORITIES = __config.queue_priorities
+
+'''
+Comment coalescing
+'''
+COALESCE_WINDOW = settings.get('coalesce', {}).get('window', 0)
+COALESCE_MAX_DELAY = settings.get('coalesce', {}).get('max_delay', 60)
+
+'''
+Notification journal
+'''
+JOURNAL_PATH = settings.get('journal', {}).get('path', 'journal.sqlite3')
+JOURNAL_FLUSH_INTERVAL = settings.get('journal', {}).get('flush_interval', 0.005)
+JOURNAL_COMPACT_INTERVAL = settings.get('journal', {}).get('compact_interval', 60)
+
+'''
+Webhook deduplication
+'''
+DEDUP_SIZE = settings.get('dedup', {}).get('size', 10000)
+DEDUP_TTL = settings.get('dedup', {}).get('ttl', 3600)
+DEDUP_PATH = settings.get('dedup', {}).get('path', '')
+
+'''
+Configuration reloading
+'''
+CONFIG_WATCH_INTERVAL = settings.get('reload', {}).get('watch_interval', 5)
+
+'''
+Background sync of setup.py
+'''
+SYNC_INTERVAL = settings.get('sync', {}).get('interval', 300)
+
+'''
+Response cache of setup.py
+'''
+HTTP_CACHE_PATH = settings.get('http_cache', {}).get('path', 'http_cache.sqlite3')
+HTTP_CACHE_GITLAB_TTL = settings.get('http_cache', {}).get('gitlab_ttl', 0)
+HTTP_CACHE_SLACK_TTL = settings.get('http_cache', {}).get('slack_ttl', 600)
+
 '''
 Google Sheets
 '''
@@ -29,6 +92,10 @@ GOOGLE_SHEETS_COL_GITLAB_UNAMES = settings['gsheets']['column_gitlab_unames']
 GOOGLE_SHEETS_COL_GITLAB_REPOS = settings['gsheets']['column_gitlab_repos']
 GOOGLE_SHEETS_CLIENT_SECRET_PATH = settings['gsheets']['client_secret_path']
 GOOGLE_SHEETS_COLUMN_OFFSET = settings['gsheets']['column_offset']
+GOOGLE_SHEETS_CHUNK_ROWS = settings['gsheets'].get('chunk_rows', 1000)
+# Discovery document of the Sheets API, downloaded once. Delete the file to get a fresh one
+GOOGLE_SHEETS_DISCOVERY_CACHE = os.path.expanduser(
+    settings['gsheets'].get('discovery_cache', '~/.credentials/sheets.googleapis.discovery-v4.json'))
 
 '''
 Gitlab
@@ -36,39 +103,56 @@ Gitlab
 __GITLAB_BASE_URL = settings['gitlab']['root_url'] + 'api/v4/'
 GITLAB_GET_PROJECTS_URL = __GITLAB_BASE_URL + 'users/{username}/projects?simple=true'
 GITLAB_GET_USER_URL = __GITLAB_BASE_URL + 'users?username={username}'
+GITLAB_GET_PROJECT_URL = __GITLAB_BASE_URL + 'projects/{path}'  # URL-encoded 'namespace/name', or the id
 GITLAB_GET_PROJECT_HOOKS = __GITLAB_BASE_URL + '/projects/{project_id}/hooks'
 GITLAB_GET_PUT_DELETE_PROJECT_HOOK = __GITLAB_BASE_URL + '/projects/{project_id}/hooks/{hook_id}'
 GITLAB_POST_WEBHOOK_URL = __GITLAB_BASE_URL + 'projects/{project_id}/hooks'
 GITLAB_EVENT_ISSUE = 'Issue Hook'
 GITLAB_EVENT_NOTE = 'Note Hook'
-GITLAB_AUTH_HEADER = {'PRIVATE-TOKEN': settings['gitlab']['auth_token']}
+GITLAB_EVENT_HEADER = 'X-Gitlab-Event'
+GITLAB_EVENT_UUID_HEADER = 'X-Gitlab-Event-UUID'
+GITLAB_AUTH_HEADER = __config.gitlab_auth_header
+GITLAB_CONCURRENCY = settings['gitlab'].get('concurrency', 10)
+GITLAB_MAX_RETRIES = settings['gitlab'].get('max_retries', 3)
+GITLAB_RETRY_BACKOFF = settings['gitlab'].get('retry_backoff', 1.0)
 
 '''
 Slack
 '''
-__SLACK_BASE_URL = 'https://slack.com/api/'
+__SLACK_BASE_URL = settings['slack'].get('api_url', 'https://slack.com/api/')
 SLACK_POST_MESSAGE_URL = __SLACK_BASE_URL + 'chat.postMessage'
 SLACK_GET_USER_LIST_URL = __SLACK_BASE_URL + 'users.list'
-SLACK_AUTH_HEADER = {'Authorization': 'Bearer ' + settings['slack']['auth_token']}
+SLACK_AUTH_HEADER = __config.slack_auth_header
+SLACK_MAX_RETRIES = __config.slack_max_retries
+SLACK_RETRY_BACKOFF = __config.slack_retry_backoff
+# Rate limits as (tokens per second, burst). See https://api.slack.com/docs/rate-limits
+SLACK_POST_MESSAGE_RATE = (1.0, 3)  # Per channel
+SLACK_TIER_2 = (20 / 60, 20)  # Per method
 
 '''
 Stringsssl_verify
 '''
-ISSUE_MSG_TO_USER = settings['slack']['messages']['issue']['to_user']
-ISSUE_MSG_TO_AUTHOR = settings['slack']['messages']['issue']['to_author']
-NOTE_MSG_TO_ALL = settings['slack']['messages']['note']['to_all']
+ISSUE_MSG_TO_USER = __config.issue_msg_to_user
+ISSUE_MSG_TO_AUTHOR = __config.issue_msg_to_author
+NOTE_MSG_TO_ALL = __config.note_msg_to_all
 ISSUE_COLOR = '#d32f2f'
+# Attachment overrides by template name, see default_templates() in events.py for the names and the defaults
+SLACK_TEMPLATES = __config.slack_templates
+SLACK_MAX_TEXT_LENGTH = __config.slack_max_text_length
 
 ''''
 Database keys
 '''
 KEY_SLACK_UNAME = 'slack_username'
 KEY_SLACK_ID = 'slack_id'
+KEY_SLACK_SHEET_NAME = 'slack_sheet_name'  # Slack name as written in the sheet, KEY_SLACK_UNAME is the handle
 KEY_GITLAB_UNAME = 'gitlab_username'
 KEY_GITLAB_USER_ID = 'gitlab_id'
 KEY_GITLAB_REPO_NAME = 'gitlab_repo_name'  # Optional
 KEY_GITLAB_REPO_ID = 'gitlab_repo_id'  # Optional
 KEY_GITLAB_REPO_HOOK_ID = 'gitlab_repo_hook_id'  # Optional
+KEY_USERS_VERSION = 'users_version'  # Id of the version stamp document in the meta collection
+KEY_SHEET_FINGERPRINT = 'sheet_fingerprint'  # Id of the document with the fingerprint of the last synced sheet
 
 '''
 Supported operations & options
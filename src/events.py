@@ -0,0 +1,185 @@
+"""
+Turns GitLab webhook events into Slack messages. Shared by the webhook servers (app.py and async_app.py).
+
+Every handler takes the event payload and a UserDirectory and returns the list of messages to be delivered,
+or None if the event can't be handled. Messages are rendered from templates compiled once, at import, and again
+whenever the configuration is reloaded.
+Handlers of new event types are registered with the @handles decorator.
+"""
+from consts import *
+from consts.config import add_config_listener, add_config_validator, current_config
+from utils import compile_templates, warning
+
+
+def _escape(text):
+    """Configured texts are static, braces in them aren't placeholders."""
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+def default_templates(config):
+    """Returns:
+            (dict): Attachment specs by template name, with the message texts of the config.
+    """
+    return {
+        # Placeholders: author, assignee, title, url, description
+        'issue.to_user': {
+            'color': ISSUE_COLOR, 'pretext': _escape(config.issue_msg_to_user),
+            'fields': [{'title': 'Assigned by', 'value': '@{author}', 'short': 'false'}],
+            'title': '{title}', 'title_link': '{url}', 'text': '{description}'},
+        'issue.to_author': {
+            'color': ISSUE_COLOR, 'pretext': _escape(config.issue_msg_to_author),
+            'fields': [{'title': 'Assigned to', 'value': '@{assignee}', 'short': 'false'}],
+            'title': '{title}', 'title_link': '{url}', 'text': '{description}'},
+        # Placeholders: author, url, note
+        'note.to_all': {
+            'color': ISSUE_COLOR, 'pretext': _escape(config.note_msg_to_all),
+            'fields': [{'title': 'Commented by', 'value': '@{author}', 'short': 'false'}],
+            'title': 'CLick here for details', 'title_link': '{url}', 'text': '{note}'},
+        # Several comments delivered as one message. Placeholders: count, authors, url, notes
+        'note.digest': {
+            'color': ISSUE_COLOR, 'pretext': _escape(config.note_msg_to_all) + ' (x{count})',
+            'fields': [{'title': 'Commented by', 'value': '{authors}', 'short': 'false'}],
+            'title': 'CLick here for details', 'title_link': '{url}', 'text': '{notes}'},
+    }
+
+
+def compile_config_templates(config):
+    return compile_templates({**default_templates(config), **config.slack_templates}, config.slack_max_text_length)
+
+
+def validate_config_templates(config):
+    """Compiles the templates of a new config and renders each of them once, raises if any of them fails."""
+    for name, template in compile_config_templates(config).items():
+        try:
+            template.render('U0')
+        except Exception as e:
+            raise ValueError('Template {0} doesn\'t render: {1}'.format(name, e))
+
+
+def _reload_templates(config):
+    # Handlers read TEMPLATES once per event, rebinding it is atomic
+    global TEMPLATES
+    TEMPLATES = compile_config_templates(config)
+
+
+TEMPLATES = compile_config_templates(current_config())
+# A config with broken templates is rejected before it's installed
+add_config_validator(validate_config_templates)
+add_config_listener(_reload_templates)
+
+# Handlers by the value of the X-Gitlab-Event header
+EVENT_HANDLERS = {}
+# Payload fields read by the handlers (and by the delivery dedup), everything else is skipped when parsing
+EVENT_FIELDS = {}
+
+
+def handles(event_type, fields):
+    """Registers the decorated function as the handler of a GitLab event type.
+
+        Args:
+            :param event_type: (str):   Value of the X-Gitlab-Event header, e.g. 'Merge Request Hook'.
+            :param fields:     ([str]): Dotted paths of the payload fields the handler reads.
+
+    The event type is added to SUPPORTED_GITLAB_EVENTS. Its delivery priority is set in queue.priorities of
+    app.config.yaml.
+    """
+    def register(handler):
+        EVENT_HANDLERS[event_type] = handler
+        # The id and timestamp identify a delivery, see delivery_key()
+        EVENT_FIELDS[event_type] = ['object_attributes.id', 'object_attributes.updated_at'] + list(fields)
+        if event_type not in SUPPORTED_GITLAB_EVENTS:
+            SUPPORTED_GITLAB_EVENTS.append(event_type)
+        return handler
+    return register
+
+
+@handles(GITLAB_EVENT_ISSUE, [
+    'object_attributes.project_id', 'object_attributes.url', 'object_attributes.title',
+    'object_attributes.description', 'user.username'])
+def issue_messages(payload, directory):
+    user = get_user(payload, directory)
+    author = get_author(payload, directory)
+    issue = get_issue(payload)
+
+    if not user: return None
+    if not author: author = {}
+
+    issue['author'] = author.get(KEY_SLACK_UNAME)
+    issue['assignee'] = user.get(KEY_SLACK_UNAME)
+
+    templates = TEMPLATES
+    messages = [templates['issue.to_user'].render(user.get(KEY_SLACK_ID), **issue)]
+    if author.get(KEY_SLACK_ID):
+        messages.append(templates['issue.to_author'].render(author.get(KEY_SLACK_ID), **issue))
+    return messages
+
+
+@handles(GITLAB_EVENT_NOTE, [
+    'object_attributes.project_id', 'object_attributes.url', 'object_attributes.note',
+    'issue.id', 'issue.url', 'issue.author_id', 'user.username'])
+def note_messages(payload, directory):
+    issue_owner = directory.find_by_gitlab_user_id(payload.get('issue', {}).get('author_id', ''))
+    comment_author = get_author(payload, directory)
+    repo_owner = get_user(payload, directory)
+    note = get_note(payload)
+
+    if not comment_author: comment_author = {}
+
+    notify_repo_owner = repo_owner and repo_owner != issue_owner and repo_owner != comment_author
+    notify_issue_owner = issue_owner and issue_owner != comment_author
+
+    note['author'] = comment_author.get(KEY_SLACK_UNAME)
+
+    template = TEMPLATES['note.to_all']
+    messages = []
+    if notify_issue_owner:
+        messages.append(template.render(issue_owner.get(KEY_SLACK_ID), **note))
+    if notify_repo_owner:
+        messages.append(template.render(repo_owner.get(KEY_SLACK_ID), **note))
+    return messages
+
+
+def note_batch_key(payload, message):
+    """Comments to the same recipient on the same issue can be delivered together."""
+    issue = payload.get('issue', {})
+    return message.channel, issue.get('id', issue.get('url'))
+
+
+def combine_note_messages(messages):
+    """Merges note messages to the same recipient into one message listing all the comments."""
+    if len(messages) == 1:
+        return messages[0]
+    notes = [m.values for m in messages]
+    authors = []
+    for note in notes:
+        author = '@{0}'.format(note.get('author'))
+        if author not in authors:
+            authors.append(author)
+    return TEMPLATES['note.digest'].render(
+        messages[0].channel, count=len(notes), authors=', '.join(authors), url=notes[-1].get('url'),
+        notes='\n\n'.join('@{0}: {1}'.format(note.get('author'), note.get('note') or '') for note in notes))
+
+
+def get_user(payload, directory):
+    oa = payload.get('object_attributes', {})
+    project_id = oa.get('project_id')
+    user = directory.find_by_repo_id(project_id)
+    if user: return user
+    warning('Received an event for project with id {0}, but can\'t find the owner.'.format(project_id))
+
+
+def get_author(payload, directory):
+    uname = payload.get('user', {}).get('username', "")
+    author = directory.find_by_gitlab_uname(uname)
+    if author: return author
+    warning('Can\'t find user {0} in the database'.format(uname))
+
+
+def get_issue(payload):
+    oa = payload.get('object_attributes', {})
+    return {'title': oa.get('title'), 'url': oa.get('url'), 'description': oa.get('description')}
+
+
+def get_note(payload):
+    oa = payload.get('object_attributes', {})
+    return {'url': oa.get('url'), 'note': oa.get('note')}
@@ -1,13 +1,22 @@
 #!/usr/bin/env python3
+import argparse
+import hashlib
+import json
 import pprint
+import time
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
 
 import pymongo
 import requests
+from oauth2client import tools
 from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
 
 from consts import *
 from utils import *
+from utils.gsheets_client import GoogleSheetsClient
 
 import urllib3
 
@@ -16,13 +25,24 @@ urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 try:
     client = MongoClient(MONGO_ADDRESS, MONGO_PORT, serverSelectionTimeoutMS=10)
     user_collection = client.iax058x.users
+    meta_collection = client.iax058x.meta
 except ServerSelectionTimeoutError:
     error('Mongo timeout. '
           'Make sure Mongo server is running and the port number is same as in the configuration file!')
     exit(1)
 
+# Shared by the lookup threads, one keep-alive connection each. Repeated runs mostly get 304s from the cache
+gitlab_client = GitLabClient(GITLAB_AUTH_HEADER, pool_size=GITLAB_CONCURRENCY,
+                             cache=HttpCache(HTTP_CACHE_PATH, HTTP_CACHE_GITLAB_TTL) if HTTP_CACHE_PATH else None)
 
-def config():
+# What our webhook has to look like in every project of a verified user
+WEBHOOK_SETTINGS = {'url': SERVER_ADDRESS, 'issues_events': True, 'note_events': True}
+
+# One step of the webhook plan. action is 'create', 'update', 'delete' or 'keep', hook_id is None for 'create'.
+WebhookChange = namedtuple('WebhookChange', ['action', 'project_id', 'hook_id'])
+
+
+def config(dry_run=False):
     if DATA_FROM == INPUT_DATA_SOURCE_GS:
         users = load_gsheets_data()
     else:
@@ -39,71 +59,133 @@ def config():
     info('Verifying Gitlab usernames and projects.')
     users = verify_gitlab_users(users)
     info('Verified {0} users.'.format(len(users)))
-    users = verify_old_users(users)
+    users = verify_old_users(users, old_users)
     info('Verified {0} users: {1}. This is final:'
          .format(len(users), [(u.get(KEY_SLACK_UNAME) + " : " + u.get(KEY_GITLAB_UNAME)) for u in users]))
     pprint.pprint(users)
+    info('Planning Gitlab webhooks.')
+    plan = plan_gitlab_webhooks(users, old_users)
+    print_gitlab_webhook_plan(plan)
+    if dry_run:
+        info('Dry run, nothing changed.')
+        return
     warning('Continuing will override all existing data. Want to continue? (yes/no)')
     if input().lower() != 'yes':
         return
-    info('Deleting old Gitlab webhooks.')
-    delete_gitlab_webhooks(old_users)
-    info('Setting new Gitlab webhooks.')
-    set_gitlab_webhooks(users)
-    info('Inserting into db.')
-    mongo_insert_users(users)
+    info('Applying Gitlab webhook changes.')
+    apply_gitlab_webhook_plan(plan, users)
+    info('Updating db.')
+    mongo_sync_users(users, old_users)
     info('Done!')
 
 
-def load_gsheets_data():
-    columns = GoogleSheetsClient(GOOGLE_SHEETS_URL, GOOGLE_SHEETS_CLIENT_SECRET_PATH).get_whole_sheet()
-    slack_users = None
-    gitlab_users = None
-    gitlab_repos = None
-    users = []
-
-    # Find columns by name
-    for column in columns:
-        offset = GOOGLE_SHEETS_COLUMN_OFFSET
-        if GOOGLE_SHEETS_COL_GITLAB_UNAMES in column:
-            gitlab_users = column[offset:]
-        elif GOOGLE_SHEETS_COL_SLACK_UNAMES in column:
-            slack_users = column[offset:]
-        elif GOOGLE_SHEETS_COL_GITLAB_REPOS in column:
-            gitlab_repos = column[offset:]
-        if gitlab_users and slack_users and gitlab_repos:
-            break
+def sync():
+    """Keeps the db and the webhooks in line with the sheet, without prompts, every SYNC_INTERVAL seconds."""
+    info('Syncing users every {0} seconds.'.format(SYNC_INTERVAL))
+    while True:
+        try:
+            sync_once()
+        except (Exception, SystemExit) as e:
+            # Helpers exit on fatal errors in interactive runs, the daemon tries again instead
+            error('Sync failed, retrying in {0} seconds: {1!r}'.format(SYNC_INTERVAL, e))
+        time.sleep(SYNC_INTERVAL)
+
+
+def sync_once():
+    """Applies the changes made to the sheet since the last sync.
+
+    The sheet is the only source of users here: rows verified before are taken from the db as they are, only new
+    and changed rows are verified, and users no longer in the sheet are removed. Webhooks are reconciled in the
+    projects of the added and removed users only. Nothing is done if the user columns have the fingerprint of the
+    last sync.
+    """
+    if DATA_FROM != INPUT_DATA_SOURCE_GS:
+        # Nothing else is supported, see config()
+        return
+    rows = OrderedDict((get_row_key(u), u) for u in load_gsheets_data(required=False))
+    fingerprint = hashlib.sha256(json.dumps(sorted(rows)).encode('utf-8')).hexdigest()
+    if fingerprint == mongo_get_sheet_fingerprint():
+        info('Sheet unchanged, nothing to sync.')
+        return
+    if not rows:
+        warning('No users in the sheet, keeping the current ones.')
+        return
+
+    old_users = mongo_get_users()
+    stored_users = {get_row_key(u): u for u in old_users}
+    # Copies, the webhook changes below must show up as differences to the stored users
+    kept_users = [dict(stored_users[key]) for key in rows if key in stored_users]
+    new_users = [user for key, user in rows.items() if key not in stored_users]
+    removed_users = [u for key, u in stored_users.items() if key not in rows]
+    info('Sheet changed: {0} users unchanged, {1} new or changed, {2} removed.'
+         .format(len(kept_users), len(new_users), len(removed_users)))
+
+    verified_users = []
+    if new_users:
+        verified_users = verify_slack_users(new_users, required=False)
+        if verified_users:
+            verified_users = verify_gitlab_users(verified_users, required=False)
+
+    # A changed row that failed verification, e.g. on a Slack outage, doesn't remove the user it replaces
+    verified_unames = set(u.get(KEY_GITLAB_UNAME) for u in verified_users)
+    failed_unames = set(u.get(KEY_GITLAB_UNAME) for u in new_users) - verified_unames
+    retained_users = [dict(u) for u in removed_users if u.get(KEY_GITLAB_UNAME) in failed_unames]
+    removed_users = [u for u in removed_users if u.get(KEY_GITLAB_UNAME) not in failed_unames]
+    users = kept_users + retained_users + verified_users
+
+    project_ids = set(u.get(KEY_GITLAB_REPO_ID) for u in verified_users + removed_users if u.get(KEY_GITLAB_REPO_ID))
+    if project_ids:
+        touched_users = [u for u in users if u.get(KEY_GITLAB_REPO_ID) in project_ids]
+        plan = plan_gitlab_webhooks(touched_users, [u for u in old_users if u.get(KEY_GITLAB_REPO_ID) in project_ids])
+        print_gitlab_webhook_plan(plan)
+        apply_gitlab_webhook_plan(plan, touched_users)
+    mongo_sync_users(users, old_users)
+
+    if len(verified_users) < len(new_users):
+        # Not remembering the sheet, so that the rows that failed are tried again next time
+        warning('{0} new or changed users couldn\'t be verified, retrying them on the next sync.'
+                .format(len(new_users) - len(verified_users)))
     else:
-        not_found = []
-        if not gitlab_users: not_found.append(GOOGLE_SHEETS_COL_GITLAB_UNAMES)
-        if not slack_users:  not_found.append(GOOGLE_SHEETS_COL_SLACK_UNAMES)
-        if not gitlab_repos: not_found.append(GOOGLE_SHEETS_COL_GITLAB_REPOS)
-        raise ValueError('Google Sheets column{s} \"{not_found}\" invalid or empty.'
-                         .format(not_found="\", \"".join(not_found), s="s" if len(not_found) > 1 else ""))
-
-    for i in range(0, min(len(slack_users), len(gitlab_users))):
-        if slack_users[i] and gitlab_users[i]:
+        mongo_set_sheet_fingerprint(fingerprint)
+
+
+def get_row_key(user):
+    """Returns:
+            (tuple): What a sheet row says about the user: Slack name, Gitlab username and repository. Verified
+                     users keep the Slack name of their row, see verify_slack_users().
+    """
+    return (user.get(KEY_SLACK_SHEET_NAME) or user.get(KEY_SLACK_UNAME), user.get(KEY_GITLAB_UNAME),
+            user.get(KEY_GITLAB_REPO_NAME) or '')
+
+
+def load_gsheets_data(required=True):
+    users = list(iter_gsheets_users())
+    verify_users_not_empty(users, required)
+    return users
+
+
+def iter_gsheets_users():
+    """Yields the users of the sheet as its rows arrive. Only the three user columns are read, found by name in the
+    first GOOGLE_SHEETS_COLUMN_OFFSET rows, GOOGLE_SHEETS_CHUNK_ROWS rows per request."""
+    client = GoogleSheetsClient(GOOGLE_SHEETS_URL, GOOGLE_SHEETS_CLIENT_SECRET_PATH)
+    rows = client.get_column_rows(
+        [GOOGLE_SHEETS_COL_SLACK_UNAMES, GOOGLE_SHEETS_COL_GITLAB_UNAMES, GOOGLE_SHEETS_COL_GITLAB_REPOS],
+        header_rows=GOOGLE_SHEETS_COLUMN_OFFSET)
+
+    for slack_uname, gitlab_uname, repo_name in rows:
+        # We care only about slack and gitlab usernames, the repository is optional
+        if slack_uname and gitlab_uname:
             user = {
-                KEY_SLACK_UNAME: slack_users[i],
-                KEY_GITLAB_UNAME: gitlab_users[i]
+                KEY_SLACK_UNAME: slack_uname,
+                KEY_GITLAB_UNAME: gitlab_uname
             }
-            try:
-                repo_name = gitlab_repos[i]
-                if repo_name:
-                    user[KEY_GITLAB_REPO_NAME] = repo_name
-            except IndexError:
-                # We care only about slack_users and gitlab_users, gitlab_repos can be of any length throwing exception
-                pass
-            users.append(user)
-
-    verify_users_not_empty(users)
-    return users
+            if repo_name:
+                user[KEY_GITLAB_REPO_NAME] = repo_name
+            yield user
 
 
-def get_gitlab_user_projects(user):
+def get_gitlab_user_projects(user, response):
     uname = user.get(KEY_GITLAB_UNAME)
-    response = requests.get(GITLAB_GET_PROJECTS_URL.format(username=uname),
-                            headers=GITLAB_AUTH_HEADER, timeout=REQUEST_TIMEOUT, verify=SSL_VERIFY)
     projects = response.json()
     if response.status_code == requests.codes.ok:
         if projects:
@@ -121,58 +203,65 @@ def get_gitlab_user_projects(user):
         warning('Woops, something went wrong! Gitlab returned {0}'.format(response.status_code))
 
 
-def verify_slack_users(users):
-    response = requests.get(SLACK_GET_USER_LIST_URL, headers=SLACK_AUTH_HEADER, timeout=REQUEST_TIMEOUT)
-    slack_users = response.json().get("members", [])
+def verify_slack_users(users, required=True):
     verified_users = []
 
-    # A list of usernames for more efficient searches
-    unames = [u.get(KEY_SLACK_UNAME, None) for u in users]
+    # Indices of the users not verified yet by Slack username, in sheet order
+    unverified = {}
+    for index, user in enumerate(users):
+        unverified.setdefault(user.get(KEY_SLACK_UNAME, None), deque()).append(index)
 
-    def verify_user(slack_uname, slack_id, user_index):
-        unames[user_index] = None
-        user = users[user_index].copy()
+    def verify_user(slack_uname, slack_id, indices):
+        user = users[indices.popleft()].copy()
+        # The sheet may give a display or real name, sync compares rows by what the sheet says
+        user.setdefault(KEY_SLACK_SHEET_NAME, user.get(KEY_SLACK_UNAME))
         user[KEY_SLACK_UNAME] = slack_uname
         user[KEY_SLACK_ID] = slack_id
         verified_users.append(user)
 
-    for slack_user in slack_users:
-        name = slack_user.get('name', None)
-        real_name = slack_user.get('real_name', None)
-        display_name = slack_user.get('profile', {}).get('display_name', None)
-        user_id = slack_user.get('id', None)
-        deleted = slack_user.get('deleted')
-        if deleted:
-            continue
-        try:
-            verify_user(name, user_id, unames.index(display_name))
-            continue
-        except ValueError:
-            pass
-        try:
-            # Couldn't find by display name, trying by real name
-            verify_user(name, user_id, unames.index(real_name))
-            continue
-        except ValueError:
-            pass
-        try:
-            # Couldn't find by real name, trying by name
-            verify_user(name, user_id, unames.index(name))
-            continue
-        except ValueError:
-            pass
-
-    verify_users_not_empty(verified_users)
+    # Members are matched page by page, so only one page is in memory at a time
+    cache = HttpCache(HTTP_CACHE_PATH, HTTP_CACHE_SLACK_TTL) if HTTP_CACHE_PATH else None
+    for result in SlackClient(SLACK_AUTH_HEADER, cache=cache).list_users_pages():
+        if not result.ok:
+            warning('Couldn\'t list Slack users. Slack returned {0}'.format(result.error))
+            break
+        for slack_user in result.data.get("members", []):
+            name = slack_user.get('name', None)
+            real_name = slack_user.get('real_name', None)
+            display_name = slack_user.get('profile', {}).get('display_name', None)
+            user_id = slack_user.get('id', None)
+            deleted = slack_user.get('deleted')
+            if deleted:
+                continue
+            # Try by display name first, then by real name, then by name
+            for candidate in (display_name, real_name, name):
+                indices = unverified.get(candidate) if candidate else None
+                if indices:
+                    verify_user(name, user_id, indices)
+                    break
+
+    verify_users_not_empty(verified_users, required)
     return verified_users
 
 
-def verify_gitlab_users(users):
+def verify_gitlab_users(users, required=True):
     verified_users = []
 
+    # Requests run in parallel and for every user and repository only once, results are checked (and warned
+    # about) in order
+    unames = set(u.get(KEY_GITLAB_UNAME, '') for u in users)
+    with ThreadPoolExecutor(max_workers=GITLAB_CONCURRENCY) as executor:
+        user_responses = dict(zip(unames, executor.map(fetch_gitlab_user, unames)))
+        repos = set(get_gitlab_repo_key(u.get(KEY_GITLAB_UNAME, ''), u.get(KEY_GITLAB_REPO_NAME)) for u in users
+                    if u.get(KEY_GITLAB_REPO_NAME) and gitlab_user_exists(user_responses[u.get(KEY_GITLAB_UNAME, '')]))
+        # Project listing pages by user and page number, only for this call, so every run sees new projects
+        pages = {}
+        projects = dict(zip(repos, executor.map(lambda repo: resolve_gitlab_project(*repo, pages=pages), repos)))
+
     for user in users:
         repo_name = user.get(KEY_GITLAB_REPO_NAME, '').lower()
         uname = user.get(KEY_GITLAB_UNAME, '')
-        user_data = verify_gitlab_user(user)
+        user_data = verify_gitlab_user(user_responses[uname])
 
         if not repo_name:
             warning('Gitlab user \'{username}\' doesn\'t have a repository field. Verifying username only.'
@@ -190,29 +279,79 @@ def verify_gitlab_users(users):
         user[KEY_GITLAB_USER_ID] = user_data.get('id')
 
         # User does have a Gitlab repo. Verifying both username and repo name.
-        projects = get_gitlab_user_projects(user)
-        if not projects:
+        project, failed_response = projects[get_gitlab_repo_key(uname, repo_name)]
+        if failed_response is not None:
+            get_gitlab_user_projects(user, failed_response)
             continue
-        for project in projects:
-            r_name = project.get('name', '')
-            if repo_name == r_name.lower():
-                r_id = project.get('id', '')
-                user[KEY_GITLAB_REPO_ID] = r_id
-                break
+        if project:
+            user[KEY_GITLAB_REPO_ID] = project.get('id', '')
         else:
             warning('Couldn\'t find project {0} for user \'{1}\'.'.format(repo_name, uname))
         verified_users.append(user)
 
-    if not verified_users:
+    if not verified_users and required:
         warning('Couldn\'t verify any gitlab users. Make sure Gitlab auth token is correct.')
         exit(1)
     return verified_users
 
 
-def verify_gitlab_user(user):
-    uname = user.get(KEY_GITLAB_UNAME)
-    response = requests.get(GITLAB_GET_USER_URL.format(username=uname),
-                            headers=GITLAB_AUTH_HEADER, timeout=REQUEST_TIMEOUT, verify=SSL_VERIFY)
+def fetch_gitlab_user(uname):
+    return gitlab_client.get(GITLAB_GET_USER_URL.format(username=uname))
+
+
+def gitlab_user_exists(response):
+    return response.status_code == requests.codes.ok and bool(response.json())
+
+
+def get_gitlab_repo_key(uname, repo_name):
+    """Repositories are given as a name in the user's namespace or as a full path, 'namespace/name'.
+
+        Returns:
+            (tuple): Owner whose projects are searched by name, None for a full path, and the lowercase repository.
+    """
+    repo_name = repo_name.lower()
+    return (None if '/' in repo_name else uname), repo_name
+
+
+def resolve_gitlab_project(uname, repo_name, pages=None):
+    """Looks the project up by its path. A name that isn't the path of a project in the user's namespace, e.g. one
+    with spaces or of a project shared with the user, is searched for in the user's projects page by page.
+
+        Returns:
+            (dict):              The project, None if there's no such project.
+            (requests.Response): Response of the project listing if it failed or was empty, None otherwise.
+
+    Listing pages are looked up in and added to `pages`, if given, as several names may have to be searched for in
+    the projects of one user.
+    """
+    path = repo_name if uname is None else '{0}/{1}'.format(uname, repo_name)
+    response = gitlab_client.get(GITLAB_GET_PROJECT_URL.format(path=quote(path, safe='')))
+    if response.status_code == requests.codes.ok:
+        return response.json(), None
+    if uname is None:
+        return None, None
+
+    page = '1'
+    while page:
+        response = pages.get((uname, page)) if pages is not None else None
+        if response is None:
+            response = get_gitlab_user_projects_page(uname, page)
+            if pages is not None and response.status_code == requests.codes.ok:
+                pages[uname, page] = response
+        if response.status_code != requests.codes.ok or (page == '1' and not response.json()):
+            return None, response
+        for project in response.json():
+            if repo_name in (project.get('name', '').lower(), project.get('path', '').lower()):
+                return project, None
+        page = response.headers.get('X-Next-Page')
+    return None, None
+
+
+def get_gitlab_user_projects_page(uname, page):
+    return gitlab_client.get(GITLAB_GET_PROJECTS_URL.format(username=uname), params={'per_page': 100, 'page': page})
+
+
+def verify_gitlab_user(response):
     if response.status_code != requests.codes.ok:
         warning('Woops, something went wrong! Gitlab returned {0}'.format(response.status_code))
     elif response.json():
@@ -220,14 +359,13 @@ def verify_gitlab_user(user):
         return response.json()[0]
 
 
-def verify_users_not_empty(users):
-    if not users:
+def verify_users_not_empty(users, required=True):
+    if not users and required:
         error('No verified users. Exiting!')
         exit(1)
 
 
-def verify_old_users(new_users):
-    old_users = mongo_get_users()
+def verify_old_users(new_users, old_users):
     if not old_users:
         return new_users
     new_unames = set([u.get(KEY_GITLAB_UNAME) for u in new_users])
@@ -237,7 +375,8 @@ def verify_old_users(new_users):
     if not diff_unames:
         return new_users
 
-    diff_users = [[item for item in old_users if item[KEY_GITLAB_UNAME] == uname][0] for uname in diff_unames]
+    old_users_by_uname = {u.get(KEY_GITLAB_UNAME): u for u in old_users}
+    diff_users = [old_users_by_uname[uname] for uname in diff_unames]
     warning('The following users are in db, but not in the new dataset: {users}'.format(users=diff_unames))
     print('Choose an option..\nK - keep all\nD - delete all\nC - choose for each user manually')
 
@@ -267,7 +406,7 @@ def verify_old_users(new_users):
                 break
             print('Choose \'K\' or \'D\'')
 
-    return new_users + diff_users
+    return new_users + tmp
 
 
 def mongo_get_users():
@@ -279,69 +418,183 @@ def mongo_get_users():
         raise
 
 
-def mongo_insert_users(users):
+def mongo_get_sheet_fingerprint():
+    document = meta_collection.find_one({'_id': KEY_SHEET_FINGERPRINT})
+    return document and document.get('fingerprint')
+
+
+def mongo_set_sheet_fingerprint(fingerprint):
+    meta_collection.update_one({'_id': KEY_SHEET_FINGERPRINT},
+                               {'$set': {'fingerprint': fingerprint, 'updated_at': time.time()}}, upsert=True)
+
+
+def mongo_sync_users(users, old_users):
+    """Makes the stored users match `users`, keyed by Gitlab username, with one ordered bulk write.
+
+    Unchanged users aren't touched, and the collection is never empty in between, so a running server keeps
+    finding everyone who stays.
+    """
     if not users:
         return
+    old_users_by_uname = {u.get(KEY_GITLAB_UNAME): u for u in old_users}
+    operations = []
+    for user in users:
+        uname = user.get(KEY_GITLAB_UNAME)
+        document = {k: v for k, v in user.items() if k != '_id'}
+        old_user = old_users_by_uname.pop(uname, None)
+        if old_user is not None and {k: v for k, v in old_user.items() if k != '_id'} == document:
+            continue
+        operations.append(pymongo.ReplaceOne({KEY_GITLAB_UNAME: uname}, document, upsert=True))
+    for old_user in old_users_by_uname.values():
+        operations.append(pymongo.DeleteOne({'_id': old_user['_id']}))
     try:
-        user_collection.drop()
-        user_collection.insert_many(users)
+        # Indexes already in place are left alone
         user_collection.create_index([(KEY_GITLAB_UNAME, pymongo.ASCENDING)])
         user_collection.create_index([(KEY_GITLAB_REPO_ID, pymongo.ASCENDING)])
         user_collection.create_index([(KEY_GITLAB_USER_ID, pymongo.ASCENDING)])
+        if not operations:
+            info('No changes.')
+            return
+        result = user_collection.bulk_write(operations, ordered=True)
+        info('Inserted {0}, updated {1} and deleted {2} users.'
+             .format(result.upserted_count, result.modified_count, result.deleted_count))
+        stamp_users_version(meta_collection)
     except ServerSelectionTimeoutError:
         error('Mongo timeout. '
               'Make sure Mongo server is running and the port number is same as in the configuration file!')
         raise
 
 
-def set_gitlab_webhooks(users):
-    for index, user in enumerate(users):
+def plan_gitlab_webhooks(users, old_users):
+    """Compares the hooks of every project, of new and old users, with WEBHOOK_SETTINGS.
+
+    Our hooks are the ones pointing at SERVER_ADDRESS and the ones recorded for old users, which may still point
+    at a previous address. Projects of verified users keep exactly one of them, updated if it differs. Other
+    projects lose all of them.
+
+        Returns:
+            (list): WebhookChange for every hook to create, update, delete or keep.
+    """
+    wanted = set(u.get(KEY_GITLAB_REPO_ID) for u in users if u.get(KEY_GITLAB_REPO_ID))
+    recorded = {}
+    for user in old_users:
         project_id = user.get(KEY_GITLAB_REPO_ID)
-        uname = user.get(KEY_GITLAB_UNAME)
+        if project_id and user.get(KEY_GITLAB_REPO_HOOK_ID):
+            recorded.setdefault(project_id, set()).add(user.get(KEY_GITLAB_REPO_HOOK_ID))
+    project_ids = wanted | set(recorded)
 
-        if not project_id:
-            # User has no gitlab repo - doesn't need a webhook.
-            continue
-        response = post_gitlab_webhook(project_id, SERVER_ADDRESS)
-        webhook_id = get_gitlab_webhook_id(project_id)
+    with ThreadPoolExecutor(max_workers=GITLAB_CONCURRENCY) as executor:
+        plans = executor.map(lambda project_id: plan_gitlab_project_webhooks(
+            project_id, project_id in wanted, recorded.get(project_id, ())), project_ids)
+        return [change for changes in plans for change in changes]
 
-        if response.status_code != requests.codes.created:
-            error('Couldn\'t set webhook for Gitlab user \'{username}\'. '
-                  'Error code: {err_code}.  Skipping'.format(username=uname, err_code=response.status_code))
-            continue
-        users[index][KEY_GITLAB_REPO_HOOK_ID] = webhook_id
 
+def plan_gitlab_project_webhooks(project_id, wanted, recorded_hook_ids):
+    response = get_gitlab_webhooks(project_id)
+    if response.status_code != requests.codes.ok:
+        error('Couldn\'t list webhooks of Gitlab project {project_id}. Error code: {err_code}. Skipping'
+              .format(project_id=project_id, err_code=response.status_code))
+        return []
+    # Hooks pointing at SERVER_ADDRESS first, those are the ones to keep
+    hooks = sorted((h for h in response.json() if h.get('url') == SERVER_ADDRESS or h.get('id') in recorded_hook_ids),
+                   key=lambda h: h.get('url') != SERVER_ADDRESS)
+    if not wanted:
+        return [WebhookChange('delete', project_id, h.get('id')) for h in hooks]
+    if not hooks:
+        return [WebhookChange('create', project_id, None)]
+
+    hook = hooks[0]
+    up_to_date = all(hook.get(key) == value for key, value in WEBHOOK_SETTINGS.items())
+    return [WebhookChange('keep' if up_to_date else 'update', project_id, hook.get('id'))] + \
+        [WebhookChange('delete', project_id, h.get('id')) for h in hooks[1:]]
+
+
+def print_gitlab_webhook_plan(plan):
+    changes = [change for change in plan if change.action != 'keep']
+    for change in sorted(changes, key=lambda c: (str(c.project_id), c.action)):
+        print('{0:6} project {1} hook {2}'.format(change.action, change.project_id, change.hook_id or '-'))
+    info('Webhooks: {0} to create, {1} to update, {2} to delete, {3} up to date.'.format(
+        *[sum(1 for c in plan if c.action == action) for action in ('create', 'update', 'delete', 'keep')]))
+
+
+def apply_gitlab_webhook_plan(plan, users):
+    """Applies the changes in parallel and stores the resulting hook id in every user of a planned project."""
+    with ThreadPoolExecutor(max_workers=GITLAB_CONCURRENCY) as executor:
+        results = list(executor.map(apply_gitlab_webhook_change, plan))
+    # Deleted duplicates don't affect the hook a project keeps
+    hook_ids = {change.project_id: hook_id for change, hook_id in zip(plan, results) if change.action != 'delete'}
 
-def delete_gitlab_webhooks(users):
     for user in users:
         project_id = user.get(KEY_GITLAB_REPO_ID)
-        webhook_id = user.get(KEY_GITLAB_REPO_HOOK_ID)
-        if project_id and webhook_id:
-            delete_gitlab_webhook(project_id=project_id, webhook_id=webhook_id)
+        if project_id in hook_ids:
+            user[KEY_GITLAB_REPO_HOOK_ID] = hook_ids[project_id]
+        elif project_id:
+            # Not planned (listing failed) or not created, the recorded hook may be stale
+            user.pop(KEY_GITLAB_REPO_HOOK_ID, None)
+
+
+def apply_gitlab_webhook_change(change):
+    """Returns:
+            (int): Id of the hook after the change, None if it was deleted or the change failed.
+    """
+    if change.action == 'keep':
+        return change.hook_id
+    if change.action == 'delete':
+        response = delete_gitlab_webhook(change.project_id, change.hook_id)
+        if response.status_code not in (requests.codes.no_content, requests.codes.not_found):
+            error('Couldn\'t delete webhook {hook_id} of Gitlab project {project_id}. Error code: {err_code}.'
+                  .format(hook_id=change.hook_id, project_id=change.project_id, err_code=response.status_code))
+        return None
+    if change.action == 'update':
+        response = put_gitlab_webhook(change.project_id, change.hook_id, **WEBHOOK_SETTINGS)
+        expected = requests.codes.ok
+    else:
+        response = post_gitlab_webhook(change.project_id, **WEBHOOK_SETTINGS)
+        expected = requests.codes.created
+    if response.status_code != expected:
+        error('Couldn\'t {action} webhook for Gitlab project {project_id}. Error code: {err_code}. Skipping'
+              .format(action=change.action, project_id=change.project_id, err_code=response.status_code))
+        return None
+    return response.json().get('id')
 
 
-def delete_gitlab_webhook(project_id, webhook_id, verify=False):
-    requests.delete(GITLAB_GET_PUT_DELETE_PROJECT_HOOK.format(
-        project_id=project_id, hook_id=webhook_id), headers=GITLAB_AUTH_HEADER,
-        timeout=REQUEST_TIMEOUT, verify=verify)
+def get_gitlab_webhooks(project_id, verify=False):
+    return gitlab_client.get(GITLAB_GET_PROJECT_HOOKS.format(
+        project_id=project_id), params={'per_page': 100}, verify=verify)
+
 
+def delete_gitlab_webhook(project_id, webhook_id, verify=False):
+    return gitlab_client.delete(GITLAB_GET_PUT_DELETE_PROJECT_HOOK.format(
+        project_id=project_id, hook_id=webhook_id), verify=verify)
 
-def get_gitlab_webhook_id(project_id, verify=False):
-    webhooks = requests.get(GITLAB_GET_PROJECT_HOOKS.format(
-        project_id=project_id), headers=GITLAB_AUTH_HEADER,
-        timeout=REQUEST_TIMEOUT, verify=verify).json()
 
-    for wh in webhooks:
-        if wh.get('url') == SERVER_ADDRESS:
-            return wh.get('id')
+def put_gitlab_webhook(project_id, webhook_id, url, issues_events=True, note_events=True, verify=False):
+    content = {'url': url, 'issues_events': issues_events, 'note_events': note_events}
+    return gitlab_client.put(GITLAB_GET_PUT_DELETE_PROJECT_HOOK.format(
+        project_id=project_id, hook_id=webhook_id), json=content, verify=verify)
 
 
-def post_gitlab_webhook(project_id, url, issue_events=True, note_events=True, verify=False):
-    content = {'url': url, 'id': project_id, 'issues_events': issue_events, 'note_events': note_events}
-    return requests.post(GITLAB_POST_WEBHOOK_URL.format(
-        project_id=project_id), headers=GITLAB_AUTH_HEADER,
-        timeout=REQUEST_TIMEOUT, json=content, verify=verify)
+def post_gitlab_webhook(project_id, url, issues_events=True, note_events=True, verify=False):
+    content = {'url': url, 'id': project_id, 'issues_events': issues_events, 'note_events': note_events}
+    return gitlab_client.post(GITLAB_POST_WEBHOOK_URL.format(
+        project_id=project_id), json=content, verify=verify)
 
 
 if __name__ == '__main__':
-    config()
+    # The oauth flags are read by GoogleSheetsClient, they're listed here so that they're accepted and documented
+    parser = argparse.ArgumentParser(
+        parents=[tools.argparser],
+        description='Loads users from Google Sheets, verifies them on Slack and '
+                    'Gitlab, sets the Gitlab webhooks and stores the users.')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--dry-run', action='store_true',
+                      help='Verify the users and print the webhook plan without changing anything.')
+    mode.add_argument('--sync', action='store_true',
+                      help='Keep syncing changes of the sheet in the background, without prompts.')
+    args = parser.parse_args()
+    if args.sync:
+        sync()
+    else:
+        # Log lines must come before the prompts they lead up to
+        write_synchronously()
+        config(dry_run=args.dry_run)
@@ -1,2 +1,12 @@
 from .printer import *
-from .gsheets_client import GoogleSheetsClient
+from .coalescer import Coalescer
+from .config_watcher import ConfigWatcher
+from .dedup_cache import DedupCache, delivery_key
+from .gitlab_client import GitLabClient
+from .http_cache import HttpCache
+from .delivery_queue import AsyncDeliveryQueue, DeliveryQueue, RetryLater
+from .journal import Journal
+from .payload import extract_fields
+from .slack_client import CHANNEL_BUSY, SlackClient, SlackResult
+from .templates import compile_templates, SlackMessage, Template
+from .user_directory import UserDirectory, stamp_users_version
@@ -0,0 +1,153 @@
+"""
+asyncio counterpart of SlackClient, used by async_app.py. Requires aiohttp.
+
+Not imported by utils/__init__.py so that aiohttp stays optional for the threaded server and setup.
+"""
+import asyncio
+import random
+
+import aiohttp
+
+from consts import *
+from .metrics import SLACK_ERRORS, SLACK_REQUEST_SECONDS, SLACK_RETRIES
+from .slack_client import SlackResult, CHANNEL_BUSY, JSON_HEADER, RETRYABLE_ERRORS
+
+
+class AsyncTokenBucket:
+
+    def __init__(self, rate, capacity):
+        """Args:
+            :param rate:     (float): Tokens added per second.
+            :param capacity: (int):   Maximum number of tokens, i.e. the allowed burst.
+        """
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = None
+
+    async def acquire(self):
+        """Takes a token, sleeping until one is available."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+    def try_acquire(self):
+        """Takes a token if one is available.
+
+            Returns:
+                (float): 0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        now = asyncio.get_event_loop().time()
+        if self.__updated is not None:
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+        self.__updated = now
+        if self.__tokens >= 1:
+            self.__tokens -= 1
+            return 0
+        return (1 - self.__tokens) / self.__rate
+
+
+class AsyncSlackClient:
+
+    def __init__(self, auth_header, timeout=REQUEST_TIMEOUT, max_retries=SLACK_MAX_RETRIES,
+                 backoff=SLACK_RETRY_BACKOFF, pool_size=100):
+        """Args:
+            :param auth_header: (dict):  Slack authorization header.
+            :param timeout:     (float): Timeout of a single HTTP request, in seconds.
+            :param max_retries: (int):   How many times a failed call is retried.
+            :param backoff:     (float): Base of the exponential backoff between retries, in seconds.
+            :param pool_size:   (int):   Maximum number of keep-alive connections to slack.com.
+
+        Must be created inside a running event loop and closed with close().
+        """
+        self.configure(auth_header, timeout, max_retries, backoff)
+        self.__session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=pool_size))
+        self.__channel_buckets = {}
+
+    def configure(self, auth_header, timeout, max_retries, backoff):
+        """Applies new settings, e.g. a rotated token. Calls in progress finish with the old ones."""
+        # One tuple, so that calls read a consistent set
+        self.__settings = ({**auth_header, **JSON_HEADER}, aiohttp.ClientTimeout(total=timeout), max_retries, backoff)
+
+    async def close(self):
+        await self.__session.close()
+
+    async def post_message(self, message, wait=True, attempt=1):
+        """Posts a message via chat.postMessage.
+
+            Args:
+                :param message: (SlackMessage): Rendered message.
+                :param wait:    (bool):         Whether to wait for the channel's rate and between retries.
+                :param attempt: (int):          Number of this attempt, when `wait` is False and the caller retries.
+
+            Returns:
+                (SlackResult): Outcome of the call, see SlackClient.post_message().
+        """
+        bucket = self.__channel_buckets.get(message.channel)
+        if not bucket:
+            bucket = self.__channel_buckets[message.channel] = AsyncTokenBucket(*SLACK_POST_MESSAGE_RATE)
+        if not wait:
+            retry_after = bucket.try_acquire()
+            if retry_after:
+                return SlackResult(False, None, CHANNEL_BUSY, attempt - 1, {'retry_after': retry_after})
+        return await self.__call('POST', SLACK_POST_MESSAGE_URL, bucket, wait=wait, first_attempt=attempt,
+                                 data=message.body)
+
+    async def __call(self, method, url, bucket, wait=True, first_attempt=1, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        status_code = None
+        err = None
+        data = {}
+        headers, timeout, max_retries, backoff = self.__settings
+
+        # At least one attempt, even if max_retries was lowered while the message waited for a retry
+        for attempt in range(first_attempt, max(first_attempt, max_retries + 1) + 1):
+            # Without waiting, the caller has taken the token
+            if wait:
+                await bucket.acquire()
+            retry_after = 0
+            try:
+                with SLACK_REQUEST_SECONDS.time(api_method):
+                    async with self.__session.request(method, url, headers=headers, timeout=timeout,
+                                                      **kwargs) as response:
+                        status_code = response.status
+                        retry_after = self.__get_retry_after(response)
+                        try:
+                            data = await response.json(content_type=None)
+                        except ValueError:
+                            data = {}
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                err = type(e).__name__
+                retry_after = 0
+            else:
+                if status_code == 429:
+                    err = 'ratelimited'
+                elif status_code >= 500:
+                    err = 'http_{0}'.format(status_code)
+                elif data.get('ok'):
+                    return SlackResult(True, status_code, None, attempt, data)
+                else:
+                    err = data.get('error', 'http_{0}'.format(status_code))
+                    if err not in RETRYABLE_ERRORS:
+                        SLACK_ERRORS.inc(api_method, err)
+                        break
+
+            SLACK_ERRORS.inc(api_method, err)
+            if attempt <= max_retries:
+                SLACK_RETRIES.inc(api_method)
+                # Full jitter, but never sooner than Slack asked us to
+                delay = max(retry_after, random.uniform(0, backoff * 2 ** (attempt - 1)))
+                if not wait:
+                    return SlackResult(False, status_code, err, attempt, {'retry_after': delay})
+                await asyncio.sleep(delay)
+
+        return SlackResult(False, status_code, err, attempt, data)
+
+    @staticmethod
+    def __get_retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
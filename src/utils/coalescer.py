@@ -0,0 +1,66 @@
+"""
+Provides per key buffering of messages, so that bursts are delivered as one message
+
+A batch is flushed once no new message arrived for `window` seconds, or `max_delay` seconds after its first
+message at the latest, so the added latency stays bounded however busy the key is.
+"""
+import threading
+import time
+
+from .printer import error
+
+
+class Coalescer:
+
+    def __init__(self, flush, window, max_delay):
+        """Args:
+            :param flush:     (callable): Called with the list of buffered messages when a batch closes.
+            :param window:    (float):    Quiet period that closes a batch, in seconds.
+            :param max_delay: (float):    Maximum age of a batch, in seconds.
+        """
+        self.__flush = flush
+        self.__window = window
+        self.__max_delay = max(window, max_delay)
+        # key -> [time of the first message, time of the last message, messages]
+        self.__batches = {}
+        self.__lock = threading.Lock()
+
+    def start(self):
+        """Starts flushing closed batches in the background."""
+        threading.Thread(target=self.__run, name='coalescer', daemon=True).start()
+
+    def add(self, key, message):
+        """Buffers the message in the batch of the key.
+
+            Args:
+                :param key:     (hashable): Messages with equal keys are delivered together.
+                :param message: (object):   Message to be buffered.
+        """
+        now = time.monotonic()
+        with self.__lock:
+            batch = self.__batches.get(key)
+            if not batch:
+                batch = self.__batches[key] = [now, now, []]
+            batch[1] = now
+            batch[2].append(message)
+
+    def pending(self):
+        """Returns:
+                (int): Number of buffered messages.
+        """
+        with self.__lock:
+            return sum(len(batch[2]) for batch in self.__batches.values())
+
+    def __run(self):
+        while True:
+            time.sleep(min(self.__window, 1) / 2)
+            now = time.monotonic()
+            with self.__lock:
+                closed = [key for key, (first, last, _) in self.__batches.items()
+                          if now - last >= self.__window or now - first >= self.__max_delay]
+                batches = [self.__batches.pop(key)[2] for key in closed]
+            for messages in batches:
+                try:
+                    self.__flush(messages)
+                except Exception as e:
+                    error('Couldn\'t flush {0} coalesced messages: {1}'.format(len(messages), e))
@@ -0,0 +1,68 @@
+"""
+Reloads app.config.yaml on SIGHUP and when the file changes
+
+Example usage:
+    ConfigWatcher(CONFIG_PATH, CONFIG_WATCH_INTERVAL).start()
+    # kill -HUP <pid>, or edit the file
+
+See consts/config.py for what is reloaded and how readers see the new settings.
+"""
+import os
+import signal
+import threading
+import time
+
+from consts.config import ConfigError, reload_config
+from .printer import error, info
+
+
+class ConfigWatcher:
+
+    def __init__(self, path, interval):
+        """Args:
+            :param path:     (str):   Path of app.config.yaml.
+            :param interval: (float): How often the file is checked for changes, in seconds. 0 to only reload
+                                      on SIGHUP.
+        """
+        self.__path = path
+        self.__interval = interval
+        self.__stamp = self.__get_stamp()
+
+    def start(self):
+        """Installs the SIGHUP handler, which has to happen on the main thread, and starts watching the file."""
+        if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+            # Reload off the signal handler, which could interrupt a thread holding locks the listeners need
+            signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+                target=self.reload, name='config-reload', daemon=True).start())
+        if self.__interval:
+            threading.Thread(target=self.__watch, name='config-watcher', daemon=True).start()
+
+    def reload(self):
+        """Returns:
+                (bool): True if the new configuration is in use, False if it was rejected.
+        """
+        try:
+            reload_config(self.__path)
+        except ConfigError as e:
+            error('Configuration not reloaded, keeping the current one. {0}'.format(e))
+            return False
+        except Exception as e:
+            error('Configuration reloaded, but applying it failed: {0}'.format(e))
+            return False
+        info('Configuration reloaded from {0}.'.format(self.__path))
+        return True
+
+    def __watch(self):
+        while True:
+            time.sleep(self.__interval)
+            stamp = self.__get_stamp()
+            if stamp != self.__stamp:
+                self.__stamp = stamp
+                self.reload()
+
+    def __get_stamp(self):
+        try:
+            stat = os.stat(self.__path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
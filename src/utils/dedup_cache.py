@@ -0,0 +1,134 @@
+"""
+Provides a size and TTL bounded LRU of handled webhook deliveries, optionally persisted to SQLite
+
+GitLab re-sends a webhook when the response is slow or fails. Remembering which deliveries were handled lets
+the server acknowledge the retries without notifying anybody twice.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from consts import *
+from .printer import error
+
+
+# How often add() deletes expired rows from the SQLite file, in seconds
+PRUNE_INTERVAL = 60
+
+
+def delivery_key(event_type, event_uuid, payload):
+    """Identifies a webhook delivery.
+
+        Args:
+            :param event_type: (str):  Value of the X-Gitlab-Event header.
+            :param event_uuid: (str):  Value of the X-Gitlab-Event-UUID header, if any.
+            :param payload:    (dict): Event payload, used when there's no uuid.
+
+        Returns:
+            (str): Key of the delivery, None if it can't be identified.
+    """
+    if event_uuid:
+        return event_uuid
+    oa = (payload or {}).get('object_attributes', {})
+    if oa.get('id') is None:
+        return None
+    identity = json.dumps([event_type, oa.get('id'), oa.get('updated_at')])
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+class DedupCache:
+
+    def __init__(self, size=DEDUP_SIZE, ttl=DEDUP_TTL, path=DEDUP_PATH):
+        """Args:
+            :param size: (int):   Maximum number of remembered deliveries.
+            :param ttl:  (float): How long a delivery is remembered, in seconds.
+            :param path: (str):   SQLite file to remember deliveries across restarts, None or '' for memory only.
+        """
+        self.__size = size
+        self.__ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__connection = None
+        self.__pruned_at = 0
+        if path:
+            self.__connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute('PRAGMA synchronous=NORMAL')
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS deliveries (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)')
+            self.__prune(time.time())
+
+    def __contains__(self, key):
+        with self.__lock:
+            return self.__lookup(key, time.time())
+
+    def reserve(self, key):
+        """Remembers the delivery as being handled, unless it's already known. Doesn't persist it: confirm with
+        add() once it's handled, or release it with discard().
+
+            Returns:
+                (bool): True if the caller should handle the delivery, False if it's handled or being handled.
+        """
+        now = time.time()
+        with self.__lock:
+            if self.__lookup(key, now):
+                return False
+            self.__remember(key, now + self.__ttl)
+            return True
+
+    def add(self, key):
+        """Remembers the delivery as handled."""
+        now = time.time()
+        expires_at = now + self.__ttl
+        with self.__lock:
+            self.__remember(key, expires_at)
+            if self.__connection:
+                try:
+                    self.__connection.execute('INSERT OR REPLACE INTO deliveries VALUES (?, ?)', (key, expires_at))
+                except sqlite3.Error as e:
+                    error('Couldn\'t persist delivery {0}: {1}'.format(key, e))
+                if now - self.__pruned_at >= PRUNE_INTERVAL:
+                    self.__prune(now)
+
+    def discard(self, key):
+        """Forgets a delivery reserved with reserve(), e.g. because handling it failed."""
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def __lookup(self, key, now):
+        expires_at = self.__entries.get(key)
+        if expires_at is None and self.__connection:
+            expires_at = self.__load(key)
+            if expires_at is not None:
+                self.__remember(key, expires_at)
+        if expires_at is None:
+            return False
+        if expires_at < now:
+            del self.__entries[key]
+            return False
+        self.__entries.move_to_end(key)
+        return True
+
+    def __prune(self, now):
+        self.__pruned_at = now
+        try:
+            self.__connection.execute('DELETE FROM deliveries WHERE expires_at < ?', (now,))
+        except sqlite3.Error as e:
+            error('Couldn\'t delete expired deliveries: {0}'.format(e))
+
+    def __remember(self, key, expires_at):
+        self.__entries[key] = expires_at
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__size:
+            self.__entries.popitem(last=False)
+
+    def __load(self, key):
+        try:
+            row = self.__connection.execute('SELECT expires_at FROM deliveries WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            error('Couldn\'t look up delivery {0}: {1}'.format(key, e))
+            return None
+        return row[0] if row else None
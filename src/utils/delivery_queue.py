@@ -0,0 +1,258 @@
+"""
+Provides a bounded in-process queue drained by a pool of background delivery workers
+
+Items are queued in priority classes, one per GitLab event type, and dequeued by weighted fair scheduling:
+a class with weight 8 gets eight items delivered for every item of a class with weight 1 while both are
+waiting, and any class gets the full throughput when the others are empty. Every class has its own bound,
+so a flood of comments can neither fill the queue for assignments nor delay them by more than a few items.
+
+An item that can't be delivered yet, e.g. because its Slack channel is rate limited, is set aside and queued
+again later instead of holding a worker, see RetryLater.
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from collections import deque, OrderedDict
+
+from .printer import error
+
+
+class RetryLater(Exception):
+    """Raised by a DeliveryQueue's deliver callable to have the item delivered again after `delay` seconds.
+    `item`, if given, is delivered instead, e.g. with the number of attempts made so far."""
+
+    def __init__(self, delay, item=None):
+        super().__init__('retry in {0:.2f}s'.format(delay))
+        self.delay = delay
+        self.item = item
+
+
+class WeightedFairQueue:
+    """Not thread-safe, see DeliveryQueue and AsyncDeliveryQueue."""
+
+    def __init__(self, weights, size):
+        """Args:
+            :param weights: (dict): Weight by priority class. Classes not listed have weight 1.
+            :param size:    (int):  Maximum number of items per class, 0 for no limit.
+        """
+        self.__weights = weights
+        self.__size = size
+        self.__queues = OrderedDict()
+        # Smooth weighted round robin: every get credits each waiting class with its weight and takes from the
+        # richest one, which pays back the sum of the weights. Only waiting classes take part.
+        self.__credits = {}
+        self.__length = 0
+
+    def __len__(self):
+        return self.__length
+
+    def put(self, item, priority=None, force=False):
+        """Returns:
+                (bool): True if the item was queued, False if its class is full and `force` isn't set.
+        """
+        if not force and self.full(priority):
+            return False
+        items = self.__queues.get(priority)
+        if items is None:
+            items = self.__queues[priority] = deque()
+            self.__credits[priority] = 0
+        items.append(item)
+        self.__length += 1
+        return True
+
+    def set_weights(self, weights):
+        self.__weights = weights
+
+    def full(self, priority=None):
+        items = self.__queues.get(priority)
+        return bool(self.__size and items and len(items) >= self.__size)
+
+    def get(self):
+        """Removes and returns the next item. Raises IndexError if the queue is empty."""
+        return self.pop()[1]
+
+    def pop(self):
+        """Removes and returns the next item together with its class, as a (priority, item) tuple. Raises
+        IndexError if the queue is empty."""
+        total = 0
+        # None is a valid class, the default one
+        chosen = found = None
+        for priority, items in self.__queues.items():
+            if not items:
+                continue
+            weight = self.__weights.get(priority, 1)
+            self.__credits[priority] += weight
+            total += weight
+            if not found or self.__credits[priority] > self.__credits[chosen]:
+                chosen, found = priority, True
+        if not found:
+            raise IndexError('get from an empty queue')
+
+        items = self.__queues[chosen]
+        self.__length -= 1
+        self.__credits[chosen] -= total
+        if len(items) == 1:
+            # An idle class doesn't save up credits for later bursts
+            self.__credits[chosen] = 0
+        return chosen, items.popleft()
+
+
+class DeliveryQueue:
+
+    def __init__(self, deliver, size, workers, weights=None):
+        """Args:
+            :param deliver: (callable): Called by a worker with every queued item. May raise RetryLater.
+            :param size:    (int):      Maximum number of items of a priority class waiting for delivery.
+            :param workers: (int):      Number of worker threads draining the queue.
+            :param weights: (dict):     Scheduling weight by priority class, see WeightedFairQueue.
+        """
+        self.__deliver = deliver
+        self.__queue = WeightedFairQueue(weights or {}, size)
+        self.__lock = threading.Lock()
+        self.__not_empty = threading.Condition(self.__lock)
+        self.__not_full = threading.Condition(self.__lock)
+        self.__all_done = threading.Condition(self.__lock)
+        self.__unfinished = 0
+        # Items waiting for a retry, a heap of (due time, sequence number, priority class, item)
+        self.__deferred = []
+        self.__sequence = itertools.count()
+        self.__workers = max(1, workers)
+        self.__threads = []
+
+    def start(self):
+        """Starts the worker threads. Workers are daemons and die together with the process."""
+        for i in range(len(self.__threads), self.__workers):
+            thread = threading.Thread(target=self.__work, name='delivery-worker-{0}'.format(i), daemon=True)
+            thread.start()
+            self.__threads.append(thread)
+
+    def put(self, item, block=False, priority=None):
+        """Enqueues the item.
+
+            Args:
+                :param item:     (object): Item to be delivered.
+                :param block:    (bool):   Whether to wait for a free slot if the class is full.
+                :param priority: (str):    Priority class of the item, i.e. the GitLab event type.
+
+            Returns:
+                (bool): True if the item was queued, False if its class is full.
+        """
+        with self.__lock:
+            while not self.__queue.put(item, priority):
+                if not block:
+                    return False
+                self.__not_full.wait()
+            self.__unfinished += 1
+            self.__not_empty.notify()
+            return True
+
+    def set_weights(self, weights):
+        """Changes the scheduling weights, e.g. after a configuration reload."""
+        with self.__lock:
+            self.__queue.set_weights(weights or {})
+
+    def depth(self):
+        """Returns:
+                (int): Number of items waiting for delivery, including those waiting for a retry.
+        """
+        with self.__lock:
+            return len(self.__queue) + len(self.__deferred)
+
+    def join(self):
+        """Blocks until every queued item has been delivered."""
+        with self.__lock:
+            while self.__unfinished:
+                self.__all_done.wait()
+
+    def __work(self):
+        while True:
+            priority, item = self.__next()
+            retry = None
+            try:
+                self.__deliver(item)
+            except RetryLater as e:
+                retry = e
+            except Exception as e:
+                error('Delivery failed: {0}'.format(e))
+            with self.__lock:
+                if retry:
+                    # Still unfinished, and not counted against the class bound until it's due
+                    heapq.heappush(self.__deferred, (time.monotonic() + retry.delay, next(self.__sequence), priority,
+                                                     item if retry.item is None else retry.item))
+                    # A worker waiting for an earlier due time must not miss this one
+                    self.__not_empty.notify()
+                    continue
+                self.__unfinished -= 1
+                if not self.__unfinished:
+                    self.__all_done.notify_all()
+
+    def __next(self):
+        with self.__lock:
+            while True:
+                now = time.monotonic()
+                while self.__deferred and self.__deferred[0][0] <= now:
+                    _, _, priority, item = heapq.heappop(self.__deferred)
+                    self.__queue.put(item, priority, force=True)
+                if len(self.__queue):
+                    break
+                self.__not_empty.wait(self.__deferred[0][0] - now if self.__deferred else None)
+            entry = self.__queue.pop()
+            # Waiters may be blocked on any class
+            self.__not_full.notify_all()
+            return entry
+
+
+class AsyncDeliveryQueue(asyncio.Queue):
+    """asyncio.Queue with the scheduling of DeliveryQueue, used by async_app.py.
+    Entries are (priority class, item) tuples, both for put() and get()."""
+
+    def __init__(self, size, weights=None):
+        self.__size = size
+        self.__weights = weights or {}
+        self.__deferred = 0
+        # Bounded per class below, not by asyncio.Queue
+        super().__init__()
+
+    def _init(self, maxsize):
+        self._queue = WeightedFairQueue(self.__weights, self.__size)
+
+    def set_weights(self, weights):
+        self._queue.set_weights(weights or {})
+
+    def _put(self, entry):
+        priority, item = entry
+        self._queue.put(item, priority, force=True)
+
+    def _get(self):
+        return self._queue.pop()
+
+    def depth(self):
+        """Returns:
+                (int): Number of entries waiting for delivery, including those waiting for a retry.
+        """
+        return self.qsize() + self.__deferred
+
+    def defer(self, entry, delay):
+        """Queues a got entry again after `delay` seconds, instead of calling task_done() for it.
+        Like forced puts, it isn't counted against the class bound."""
+        self.__deferred += 1
+        asyncio.get_event_loop().call_later(delay, self.__requeue, entry)
+
+    def __requeue(self, entry):
+        self.__deferred -= 1
+        # put_nowait() without counting the entry as a new task, it's still unfinished
+        self._put(entry)
+        self._wakeup_next(self._getters)
+
+    def put_nowait(self, entry):
+        if self._queue.full(entry[0]):
+            raise asyncio.QueueFull
+        super().put_nowait(entry)
+
+    async def put(self, entry):
+        # Only journal replay waits for free slots, polling is good enough for it
+        while self._queue.full(entry[0]):
+            await asyncio.sleep(0.1)
+        self.put_nowait(entry)
@@ -0,0 +1,120 @@
+"""
+Provides a pooled, rate limit aware client for the GitLab API, safe to share between threads
+
+Example usage:
+    client = GitLabClient(GITLAB_AUTH_HEADER, pool_size=10)
+    response = client.get(GITLAB_GET_USER_URL.format(username='bob'))
+
+Failed requests (connection errors, 429 and 5xx responses) are retried with jittered exponential backoff, never
+sooner than GitLab's Retry-After. Once GitLab reports the rate limit as used up, all threads wait for its reset.
+Given an HttpCache, GET requests are answered from it or revalidated against it.
+"""
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from consts import *
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class GitLabClient:
+
+    def __init__(self, auth_header, timeout=REQUEST_TIMEOUT, verify=SSL_VERIFY, max_retries=GITLAB_MAX_RETRIES,
+                 backoff=GITLAB_RETRY_BACKOFF, pool_size=10, cache=None):
+        """Args:
+            :param auth_header: (dict):  GitLab authorization header.
+            :param timeout:     (float): Timeout of a single HTTP request, in seconds.
+            :param verify:      (bool):  Whether to verify SSL certificates, unless given per request.
+            :param max_retries: (int):   How many times a failed request is retried.
+            :param backoff:     (float): Base of the exponential backoff between retries, in seconds.
+            :param pool_size:   (int):   Number of keep-alive connections, i.e. of threads sharing the client.
+            :param cache:       (HttpCache): Cache of GET responses, None to always fetch them.
+        """
+        self.__auth_header = dict(auth_header)
+        self.__cache = cache
+        self.__timeout = timeout
+        self.__verify = verify
+        self.__max_retries = max_retries
+        self.__backoff = backoff
+        self.__session = requests.Session()
+        self.__session.headers.update(auth_header)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session.mount('https://', adapter)
+        self.__session.mount('http://', adapter)
+        # Monotonic time until which nobody sends requests, set when the rate limit is used up
+        self.__resume_at = 0
+        self.__lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        if not self.__cache:
+            return self.request('GET', url, **kwargs)
+        headers = kwargs.pop('headers', None) or {}
+        return self.__cache.fetch(lambda validators: self.request('GET', url, headers={**headers, **validators},
+                                                                  **kwargs),
+                                  url, params=kwargs.get('params'), scope=self.__auth_header)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """Sends the request, retrying failed attempts.
+
+            Returns:
+                (requests.Response): Response of the last attempt.
+
+        Raises the requests exception of the last attempt if none of them got a response.
+        """
+        kwargs.setdefault('timeout', self.__timeout)
+        kwargs.setdefault('verify', self.__verify)
+
+        for attempt in range(1, self.__max_retries + 2):
+            self.__wait_for_rate_limit()
+            retry_after = 0
+            try:
+                response = self.__session.request(method, url, **kwargs)
+            except requests.RequestException:
+                if attempt > self.__max_retries:
+                    raise
+            else:
+                self.__note_rate_limit(response)
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt > self.__max_retries:
+                    return response
+                retry_after = self.__get_retry_after(response)
+            # Full jitter, but never sooner than GitLab asked us to
+            time.sleep(max(retry_after, random.uniform(0, self.__backoff * 2 ** (attempt - 1))))
+
+    def __wait_for_rate_limit(self):
+        with self.__lock:
+            wait = self.__resume_at - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+    def __note_rate_limit(self, response):
+        # See https://docs.gitlab.com/ee/user/admin_area/settings/user_and_ip_rate_limits.html
+        try:
+            if int(response.headers.get('RateLimit-Remaining', 1)) > 0:
+                return
+            wait = float(response.headers.get('RateLimit-Reset', 0)) - time.time()
+        except ValueError:
+            return
+        if wait > 0:
+            with self.__lock:
+                self.__resume_at = max(self.__resume_at, time.monotonic() + wait)
+
+    @staticmethod
+    def __get_retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
@@ -8,9 +8,19 @@ Example usage:
             './client_secret.json')
     client.set_cell_value('Column name', 'Row name', 'New value')
     set_value = client.get_cell_value_formatted('Column name', 'Row name')
+    client.set_cell_values([('Column name', 'Row name', 'New value'), ('Column name', 'Other row', 'Other value')])
+    for name, value in client.get_column_rows(['Names', 'Values']):
+        print(name, value)
+
+The sheet is downloaded once per snapshot, as rows, and the columns are derived from them. Row and column names are
+looked up in indexes built from the snapshot. With snapshot_ttl the snapshot serves every call for that long, so a
+batch of edits costs one download. Writes made through the client are applied to the snapshot as well.
+
+Only setup.py needs it, so it isn't imported by utils/__init__.py and the Google API client libraries stay out of
+the webhook server. The service is built from a local copy of the API discovery document, downloaded on first use.
 """
 
-import httplib2, os, re
+import httplib2, json, os, re, time
 from consts import *
 from apiclient import discovery
 from oauth2client import client, tools
@@ -23,6 +33,12 @@ APPLICATION_NAME = 'Google Sheets Master'
 DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
 SCOPES = 'https://www.googleapis.com/auth/spreadsheets'
 CLIENT_CREDENTIALS_FILE = 'google-sheets-master.json'
+# Ranges per values.batchGet request, they're sent in the URL
+BATCH_GET_SIZE = 100
+# Ranges per values.batchUpdate request, well below the API's request size limit
+BATCH_UPDATE_SIZE = 1000
+# Last row read by get_column_rows, as in SHEET_RANGE
+MAX_ROWS = 100000
 flags = None
 
 
@@ -30,18 +46,21 @@ def init_args():
     global flags
     try:
         import argparse
-        flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_args()
+        # Only the oauth flags, the rest of the command line belongs to the script using the client
+        flags = argparse.ArgumentParser(parents=[tools.argparser]).parse_known_args()[0]
     except ImportError:
         flags = None
 
 
 class GoogleSheetsClient:
 
-    def __init__(self, sheets_url, path_to_client_secret):
+    def __init__(self, sheets_url, path_to_client_secret, snapshot_ttl=0):
 
         """Args:
             :param sheets_url:            (str): URL of the Google Sheet to be processed.
             :param path_to_client_secret: (str): path to client credentials json file, relative or absolute
+            :param snapshot_ttl:        (float): How long a downloaded sheet is used, in seconds. 0 downloads it for
+                                                 every call, None keeps it until invalidate() is called.
 
         If no credentials are found or they are invalid user is prompted for authentication
         to to obtain the new credentials.
@@ -57,7 +76,15 @@ class GoogleSheetsClient:
             raise
 
         http = self.__get_credentials(path_to_client_secret).authorize(httplib2.Http())
-        self.__service = discovery.build('sheets', 'v4', http=http, discoveryServiceUrl=DISCOVERY_URL)
+        self.__service = discovery.build_from_document(self.__get_discovery_document(), http=http)
+        self.__snapshot_ttl = snapshot_ttl
+        self.__snapshot = None
+        self.__snapshot_time = 0
+
+
+    def invalidate(self):
+        """Drops the snapshot, the next call downloads the sheet again."""
+        self.__snapshot = None
 
 
     def set_cell_value(self, column_name, row_name, value, silent_mode=True):
@@ -74,14 +101,17 @@ class GoogleSheetsClient:
         """
         service = self.__service
         spreadsheet_id = self.__spreadsheet_id
-        cell_index = self.get_cell_index_formatted(column_name, row_name)
+        _, _, col_index, row_index = self.get_cell_with_context(column_name, row_name)
+        cell_index = self.__format_cell_index_to_str(col_index, row_index)
         request_body = {'values': [[value]]}
 
+        # The value as the sheet stores it, e.g. a formula's result, is written back into the snapshot
         result = service.spreadsheets().values().update(
             spreadsheetId=spreadsheet_id, range=cell_index,
-            valueInputOption='USER_ENTERED', body=request_body).execute()
+            valueInputOption='USER_ENTERED', body=request_body, includeValuesInResponse=True).execute()
 
         if result.get('updatedCells') == 1:
+            self.__update_snapshot(col_index, row_index, self.__get_single_value(result.get('updatedData', {})))
             if not silent_mode:
                 print('Cell ', cell_index, 'updated with value ', value)
             return True
@@ -91,6 +121,71 @@ class GoogleSheetsClient:
             return False
 
 
+    def set_cell_values(self, cells, silent_mode=True):
+        """Inserts many values in a Google Sheet with values.batchUpdate, BATCH_UPDATE_SIZE cells per request.
+        All names are resolved before anything is written.
+
+            Args:
+                :param cells:       ([()]): (column name, row name, value) tuples.
+                :param silent_mode: (bool): Whether log messages should be printed.
+
+            Returns:
+                ([bool]): For every cell, in the same order. True for success, False otherwise.
+        """
+        snapshot = self.__get_snapshot()
+        positions = [self.__find_cell(snapshot, column_name, row_name) for column_name, row_name, _ in cells]
+        results = []
+
+        for start in range(0, len(cells), BATCH_UPDATE_SIZE):
+            chunk = list(zip(positions[start:start + BATCH_UPDATE_SIZE], cells[start:start + BATCH_UPDATE_SIZE]))
+            request_body = {
+                'valueInputOption': 'USER_ENTERED',
+                'includeValuesInResponse': True,
+                'data': [{'range': self.__format_cell_index_to_str(col_index, row_index), 'values': [[value]]}
+                         for (col_index, row_index), (_, _, value) in chunk]
+            }
+            responses = self.__service.spreadsheets().values().batchUpdate(
+                spreadsheetId=self.__spreadsheet_id, body=request_body).execute().get('responses', [])
+
+            for index, ((col_index, row_index), (_, _, value)) in enumerate(chunk):
+                response = responses[index] if index < len(responses) else {}
+                cell_index = self.__format_cell_index_to_str(col_index, row_index)
+                if response.get('updatedCells') == 1:
+                    self.__update_snapshot(col_index, row_index,
+                                           self.__get_single_value(response.get('updatedData', {})))
+                    if not silent_mode:
+                        print('Cell ', cell_index, 'updated with value ', value)
+                    results.append(True)
+                else:
+                    if not silent_mode:
+                        print('Operation failed for cell ', cell_index)
+                    results.append(False)
+        return results
+
+
+    def get_cell_values(self, cells):
+        """Gets many values from a Google Sheet with values.batchGet, BATCH_GET_SIZE cells per request.
+
+            Args:
+                :param cells: ([()]): (column name, row name) tuples.
+
+            Returns:
+                ([str]): The cell values, in the same order.
+        """
+        snapshot = self.__get_snapshot()
+        ranges = [self.__format_cell_index_to_str(*self.__find_cell(snapshot, column_name, row_name))
+                  for column_name, row_name in cells]
+        values = []
+
+        for start in range(0, len(ranges), BATCH_GET_SIZE):
+            value_ranges = self.__service.spreadsheets().values().batchGet(
+                spreadsheetId=self.__spreadsheet_id, ranges=ranges[start:start + BATCH_GET_SIZE],
+                majorDimension='ROWS').execute().get('valueRanges', [])
+            # Empty cells come without values
+            values.extend(self.__get_single_value(value_range) for value_range in value_ranges)
+        return values
+
+
     def get_cell_value(self, column_name, row_name):
         """Gets value from a Google Sheet.
 
@@ -141,50 +236,159 @@ class GoogleSheetsClient:
                 (str)   : searched cell column index
                 (str)   : searched cell row idnex
         """
-        service = self.__service
-        spreadsheet_id = self.__spreadsheet_id
+        snapshot = self.__get_snapshot()
+        col_index, row_index = self.__find_cell(snapshot, column_name, row_name)
+        return snapshot[0], snapshot[1], col_index, row_index
 
-        rows = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id, range=SHEET_RANGE,
-            majorDimension='ROWS').execute().get('values', [])
 
-        columns = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id, range=SHEET_RANGE,
+    def get_whole_sheet(self):
+        """ Retrieves the whole sheet by the specified URL.
+
+            Returns:
+                [[]]    : 2D list Columns-Rows
+        """
+        return self.__get_snapshot()[0]
+
+
+    def get_column_rows(self, column_names, header_rows=1, chunk_rows=GOOGLE_SHEETS_CHUNK_ROWS):
+        """Reads only the given columns, a chunk of rows at a time, instead of the whole sheet.
+
+        Columns are found by name in the header rows. The rows below are fetched with one values.batchGet per
+        chunk and yielded as they arrive. Reading stops at the first chunk without any values.
+
+            Args:
+                :param column_names: ([str]): Names of the columns to read.
+                :param header_rows:  (int):   Number of rows holding the column names.
+                :param chunk_rows:   (int):   Number of rows fetched per request.
+
+            Returns:
+                (generator): Tuple of the values in the given columns for every row, '' for empty cells.
+        """
+        header_rows = max(header_rows, 1)
+        headers = self.__service.spreadsheets().values().get(
+            spreadsheetId=self.__spreadsheet_id, range='{0}!A1:ZZ{1}'.format(SHEET_NAME, header_rows),
             majorDimension='COLUMNS').execute().get('values', [])
 
+        col_indices = []
+        for name in column_names:
+            col_index = next((index for index, column in enumerate(headers) if name in column), None)
+            if col_index is None:
+                raise ValueError('Google Sheets column \"{0}\" not found.'.format(name))
+            col_indices.append(col_index)
+        columns = [self.__format_column_name(col_index) for col_index in col_indices]
+
+        for start in range(header_rows + 1, MAX_ROWS + 1, chunk_rows):
+            end = min(start + chunk_rows - 1, MAX_ROWS)
+            value_ranges = self.__service.spreadsheets().values().batchGet(
+                spreadsheetId=self.__spreadsheet_id, majorDimension='COLUMNS',
+                ranges=['{0}!{1}{2}:{1}{3}'.format(SHEET_NAME, column, start, end) for column in columns]
+            ).execute().get('valueRanges', [])
+            chunk = [(value_range.get('values') or [[]])[0] for value_range in value_ranges]
+            chunk += [[]] * (len(columns) - len(chunk))
+            if not any(chunk):
+                return
+            for index in range(max(len(values) for values in chunk)):
+                yield tuple(values[index] if index < len(values) else '' for values in chunk)
+
+
+    def __get_snapshot(self):
+        """Downloads the sheet unless the snapshot is still fresh.
+
+            Returns:
+                ([[]])  : data sheet grouped by columns
+                ([[]])  : data sheet grouped by rows
+                (dict)  : index of the first column containing a value, by value
+                (dict)  : index of the first row containing a value, by value
+        """
+        if self.__snapshot is not None and (self.__snapshot_ttl is None or
+                                            time.monotonic() - self.__snapshot_time < self.__snapshot_ttl):
+            return self.__snapshot
+
+        rows = self.__service.spreadsheets().values().get(
+            spreadsheetId=self.__spreadsheet_id, range=SHEET_RANGE,
+            majorDimension='ROWS').execute().get('values', [])
+
+        # Same as majorDimension='COLUMNS': trailing empty cells are left out
+        width = max((len(row) for row in rows), default=0)
+        columns = [[row[i] if i < len(row) else '' for row in rows] for i in range(width)]
+        for column in columns:
+            while column and column[-1] == '':
+                column.pop()
+
+        self.__snapshot = (columns, rows, self.__build_index(columns), self.__build_index(rows))
+        self.__snapshot_time = time.monotonic()
+        return self.__snapshot
+
+
+    def __update_snapshot(self, col_index, row_index, value):
+        """Applies a written cell value to the snapshot and its indexes."""
+        if self.__snapshot is None:
+            return
+        columns, rows, column_names, row_names = self.__snapshot
+        old_value = self.__set_cell(rows, row_index, col_index, value)
+        self.__set_cell(columns, col_index, row_index, value)
+        for lines, names, position in ((rows, row_names, row_index), (columns, column_names, col_index)):
+            if names.get(value, position + 1) > position:
+                names[value] = position
+            if names.get(old_value) == position and old_value not in lines[position]:
+                # The name may still be further down
+                del names[old_value]
+                for index in range(position + 1, len(lines)):
+                    if old_value in lines[index]:
+                        names[old_value] = index
+                        break
+
+
+    @staticmethod
+    def __find_cell(snapshot, column_name, row_name):
+        """Returns:
+                (int): Index of the first column containing column_name.
+                (int): Index of the first row containing row_name.
+        """
+        columns, rows, column_names, row_names = snapshot
+
         if not rows or not columns:
             raise Exception('Sheet is empty. No data to process.')
 
-        # Find column index by name
-        for index, row in enumerate(rows):
-            if row_name in row:
-                row_index = index
-                break
-        else:
+        row_index = row_names.get(row_name)
+        if row_index is None:
             raise ValueError('Invalid row name.')
-
-        # Find row index by name
-        for index, column in enumerate(columns):
-            if column_name in column:
-                col_index = index
-                break
-        else:
+        col_index = column_names.get(column_name)
+        if col_index is None:
             raise ValueError('Invalid column name.')
+        return col_index, row_index
 
-        return columns, rows, col_index, row_index
 
+    @staticmethod
+    def __get_single_value(value_range):
+        """Returns:
+                (str): Value of a single cell ValueRange, '' if the cell is empty.
+        """
+        values = value_range.get('values') or [[]]
+        return values[0][0] if values[0] else ''
 
-    def get_whole_sheet(self):
-        """ Retrieves the whole sheet by the specified URL.
 
-            Returns:
-                [[]]    : 2D list Columns-Rows
-        """
-        service = self.__service
-        spreadsheet_id = self.__spreadsheet_id
-        return service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id, range=SHEET_RANGE,
-            majorDimension='COLUMNS').execute().get('values', [])
+    @staticmethod
+    def __set_cell(lines, line_index, cell_index, value):
+        """Sets a cell in rows or columns, padding and trimming them like the API does. Returns the old value."""
+        while len(lines) <= line_index:
+            lines.append([])
+        line = lines[line_index]
+        while len(line) <= cell_index:
+            line.append('')
+        old_value, line[cell_index] = line[cell_index], value
+        while line and line[-1] == '':
+            line.pop()
+        return old_value
+
+
+    @staticmethod
+    def __build_index(lines):
+        names = {}
+        for index, line in enumerate(lines):
+            for value in line:
+                names.setdefault(value, index)
+        return names
 
 
     @staticmethod
@@ -198,12 +402,18 @@ class GoogleSheetsClient:
             Returns:
                 (str): Formatted index of the cell value
         """
+        return SHEET_NAME + '!' + GoogleSheetsClient.__format_column_name(col_index) + str(row_index + 1)
+
+
+    @staticmethod
+    def __format_column_name(col_index):
+        """Converts a column index to its name, e.g. 0 to 'A' and 26 to 'AA'."""
         col_index += 1
         col_name = ""
         while col_index > 0:
             col_index, remainder = divmod(col_index - 1, 26)
             col_name = chr(65 + remainder) + col_name
-        return SHEET_NAME + '!' + col_name + str(row_index + 1)
+        return col_name
 
 
     @staticmethod
@@ -237,6 +447,37 @@ class GoogleSheetsClient:
         return credentials
 
 
+    @staticmethod
+    def __get_discovery_document():
+        """Reads the discovery document of the Sheets API from GOOGLE_SHEETS_DISCOVERY_CACHE, downloading it
+        there first if it's missing or broken.
+
+            Returns:
+                (str): Discovery document, JSON.
+        """
+        try:
+            with open(GOOGLE_SHEETS_DISCOVERY_CACHE, 'r') as f:
+                document = f.read()
+            json.loads(document)
+            return document
+        except (IOError, ValueError):
+            pass
+
+        response, content = httplib2.Http().request(DISCOVERY_URL)
+        if response.status >= 400:
+            raise IOError('Couldn\'t download the Sheets API discovery document, HTTP {0}'.format(response.status))
+        document = content.decode('utf-8')
+        directory = os.path.dirname(GOOGLE_SHEETS_DISCOVERY_CACHE)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        # Write a temporary file and rename it, so a concurrent reader never sees half a document
+        tmp_path = GOOGLE_SHEETS_DISCOVERY_CACHE + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(document)
+        os.replace(tmp_path, GOOGLE_SHEETS_DISCOVERY_CACHE)
+        return document
+
+
     @staticmethod
     def __get_absolute_path(path):
         """Converts provided file path to absolute path. Throws IOError if file doesn't exist.
@@ -0,0 +1,119 @@
+"""
+Provides a persistent cache of GET responses, backed by SQLite, for the lookups setup.py repeats on every run
+
+Responses are keyed by URL, query parameters and a hash of the auth header, so a different token never sees
+another token's responses. A response younger than the TTL is served without a request. An older one is
+revalidated with If-None-Match / If-Modified-Since when the server sent an ETag or Last-Modified, and a 304 costs
+no body and, on GitLab, no rate limit quota.
+
+Example usage:
+    cache = HttpCache('http_cache.sqlite3', ttl=0)
+    client = GitLabClient(GITLAB_AUTH_HEADER, cache=cache)
+    client.get(url)  # 200 the first time, 304 revalidated afterwards
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from .printer import error
+
+
+class HttpCache:
+
+    def __init__(self, path, ttl=0):
+        """Args:
+            :param path: (str):   Path to the cache file, created if it doesn't exist.
+            :param ttl:  (float): How long a response is used without asking the server, in seconds. 0 revalidates
+                                  every time.
+        """
+        self.__ttl = ttl
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.__connection.executescript('''
+            PRAGMA journal_mode=WAL;
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                status INTEGER NOT NULL,
+                headers TEXT NOT NULL,
+                body BLOB NOT NULL,
+                stored_at REAL NOT NULL);
+        ''')
+
+    def fetch(self, send, url, params=None, scope=None, cacheable=None):
+        """Returns the cached response if it's fresh or still valid, otherwise the response of `send`.
+
+            Args:
+                :param send:      (callable): Sends the GET request with the given extra headers (dict) and returns
+                                              the requests.Response. Retries are up to it.
+                :param url:       (str):      Requested URL.
+                :param params:    (dict):     Query parameters.
+                :param scope:     (dict):     Auth header the request is sent with.
+                :param cacheable: (callable): Whether a 200 response may be stored, all of them if not given.
+
+            Returns:
+                (requests.Response): Response, from the cache or from the server.
+        """
+        key = self.__get_key(url, params, scope)
+        entry = self.__load(key)
+        if entry and time.time() - entry[3] < self.__ttl:
+            return self.__to_response(url, entry)
+
+        validators = {}
+        if entry:
+            etag = entry[1].get('ETag')
+            last_modified = entry[1].get('Last-Modified')
+            if etag:
+                validators['If-None-Match'] = etag
+            if last_modified:
+                validators['If-Modified-Since'] = last_modified
+
+        response = send(validators)
+        if response.status_code == requests.codes.not_modified and validators:
+            self.__store(key, url, entry[0], {**entry[1], **self.__get_validators(response.headers)}, entry[2])
+            return self.__to_response(url, entry)
+        if response.status_code == requests.codes.ok and (cacheable is None or cacheable(response)):
+            self.__store(key, url, response.status_code, dict(response.headers), response.content)
+        return response
+
+    def __load(self, key):
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT status, headers, body, stored_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row:
+            return row[0], CaseInsensitiveDict(json.loads(row[1])), row[2], row[3]
+
+    def __store(self, key, url, status, headers, body):
+        # Hop-by-hop and encoding headers describe the original transfer, not the stored body
+        headers = {k: v for k, v in headers.items()
+                   if k.lower() not in ('content-encoding', 'content-length', 'transfer-encoding', 'connection')}
+        try:
+            with self.__lock:
+                self.__connection.execute(
+                    'INSERT OR REPLACE INTO responses (key, url, status, headers, body, stored_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', (key, url, status, json.dumps(headers), body, time.time()))
+        except sqlite3.Error as e:
+            # The response is still good, only the next run has to fetch it again
+            error('Couldn\'t cache the response of {0}: {1}'.format(url, e))
+
+    @staticmethod
+    def __get_key(url, params, scope):
+        scope_hash = hashlib.sha256(json.dumps(sorted((scope or {}).items())).encode('utf-8')).hexdigest()
+        return json.dumps([url, sorted((params or {}).items()), scope_hash])
+
+    @staticmethod
+    def __get_validators(headers):
+        return {k: headers[k] for k in ('ETag', 'Last-Modified') if k in headers}
+
+    @staticmethod
+    def __to_response(url, entry):
+        response = requests.Response()
+        response.status_code, response.headers, response._content = entry[0], entry[1], entry[2]
+        response.url = url
+        response.encoding = 'utf-8'
+        return response
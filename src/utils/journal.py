@@ -0,0 +1,194 @@
+"""
+Provides a durable on-disk journal of pending Slack messages, backed by SQLite
+
+Messages are journaled before the webhook answers GitLab and marked done once delivered, so nothing is lost if
+the server dies in between: whatever is still pending is replayed on the next start. All writes go through a
+single writer thread that commits them in batches (group commit), so a burst of events costs one fsync per
+batch rather than one per message. Finished entries are deleted and their pages reclaimed periodically.
+
+Example usage:
+    journal = Journal('journal.sqlite3')
+    journal.start()
+    for entry_id, message in journal.pending():
+        deliver(message)
+        journal.done(entry_id)
+"""
+import json
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+
+from consts import *
+from .printer import error, info
+from .templates import SlackMessage
+
+
+STATE_PENDING = 'pending'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+# Upper bound of operations committed in one transaction
+MAX_BATCH = 500
+
+
+class Journal:
+
+    def __init__(self, path, flush_interval=JOURNAL_FLUSH_INTERVAL, compact_interval=JOURNAL_COMPACT_INTERVAL):
+        """Args:
+            :param path:             (str):   Path to the journal file, created if it doesn't exist.
+            :param flush_interval:   (float): How long writes are gathered into one commit, in seconds.
+            :param compact_interval: (float): How often finished entries are purged, in seconds.
+        """
+        self.__path = path
+        self.__flush_interval = flush_interval
+        self.__compact_interval = compact_interval
+        self.__ops = queue.Queue()
+        self.__thread = None
+
+    def start(self):
+        """Creates the journal if needed and starts the writer thread."""
+        connection = self.__connect()
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                id TEXT UNIQUE NOT NULL,
+                event_type TEXT,
+                message TEXT NOT NULL,
+                state TEXT NOT NULL,
+                created_at REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS messages_state ON messages (state, seq);
+        ''')
+        connection.close()
+        self.__thread = threading.Thread(target=self.__write, args=(self.__connect(),), name='journal', daemon=True)
+        self.__thread.start()
+
+    def append(self, event_type, messages, replaces=None):
+        """Journals the messages of an event. Blocks until they are on disk.
+
+            Args:
+                :param event_type: (str):    GitLab event the messages were rendered for.
+                :param messages:   ([SlackMessage]): Slack messages.
+                :param replaces:   ([str]):  Entries marked done in the same transaction, e.g. the comments
+                                             combined into a digest.
+
+            Returns:
+                ([str]): Entry ids of the messages, in the same order. None if the write failed.
+        """
+        if not messages:
+            return []
+        now = time.time()
+        rows = [(uuid.uuid4().hex, event_type, message.body.decode('utf-8'), STATE_PENDING, now)
+                for message in messages]
+        op = [self.__append_rows, (rows, replaces or []), threading.Event(), None]
+        self.__ops.put(op)
+        op[2].wait()
+        if op[3]:
+            return None
+        return [row[0] for row in rows]
+
+    def done(self, entry_id, delivered=True):
+        """Marks an entry as finished, it won't be replayed anymore. Doesn't block.
+
+            Args:
+                :param entry_id:  (str):  Id returned by append().
+                :param delivered: (bool): Whether the message was delivered or given up on.
+        """
+        self.__ops.put([self.__update_state, (STATE_DONE if delivered else STATE_FAILED, entry_id), None, None])
+
+    def pending(self, batch_size=100):
+        """Yields the entries that weren't finished, oldest first, reading them page by page.
+        Entries appended after the call are not included.
+
+            Returns:
+                (generator): (entry id, SlackMessage, event type) tuples.
+        """
+        connection = self.__connect()
+        try:
+            last_seq = connection.execute('SELECT COALESCE(MAX(seq), 0) FROM messages').fetchone()[0]
+            seq = 0
+            while True:
+                rows = connection.execute(
+                    'SELECT seq, id, message, event_type FROM messages WHERE state = ? AND seq > ? AND seq <= ? '
+                    'ORDER BY seq LIMIT ?', (STATE_PENDING, seq, last_seq, batch_size)).fetchall()
+                if not rows:
+                    return
+                for seq, entry_id, body, event_type in rows:
+                    message = SlackMessage(json.loads(body).get('channel'), body.encode('utf-8'), None)
+                    yield entry_id, message, event_type
+        finally:
+            connection.close()
+
+    def __connect(self):
+        connection = sqlite3.connect(self.__path, check_same_thread=False, isolation_level=None)
+        # WAL lets replay read while the writer commits. FULL syncs the WAL on every commit, i.e. once per batch.
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=FULL')
+        connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        return connection
+
+    def __write(self, connection):
+        last_compaction = time.monotonic()
+        while True:
+            try:
+                ops = [self.__ops.get(timeout=self.__compact_interval)]
+            except queue.Empty:
+                ops = []
+            deadline = time.monotonic() + self.__flush_interval
+            while ops and len(ops) < MAX_BATCH:
+                timeout = deadline - time.monotonic()
+                try:
+                    ops.append(self.__ops.get(timeout=timeout) if timeout > 0 else self.__ops.get_nowait())
+                except queue.Empty:
+                    break
+
+            if ops:
+                try:
+                    connection.execute('BEGIN')
+                    for op in ops:
+                        op[0](connection, op[1])
+                    connection.execute('COMMIT')
+                except Exception as e:
+                    # Anything, not only SQLite errors: if this thread died, append() would wait forever
+                    error('Couldn\'t write to the journal: {0!r}'.format(e))
+                    self.__rollback(connection)
+                    for op in ops:
+                        op[3] = e
+                for op in ops:
+                    if op[2]:
+                        op[2].set()
+
+            if time.monotonic() - last_compaction >= self.__compact_interval:
+                self.__compact(connection)
+                last_compaction = time.monotonic()
+
+    def __compact(self, connection):
+        try:
+            deleted = connection.execute('DELETE FROM messages WHERE state != ?', (STATE_PENDING,)).rowcount
+            connection.execute('PRAGMA incremental_vacuum')
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            if deleted:
+                info('Compacted the journal, purged {0} finished entries.'.format(deleted))
+        except Exception as e:
+            error('Couldn\'t compact the journal: {0!r}'.format(e))
+
+    @staticmethod
+    def __rollback(connection):
+        try:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+        except sqlite3.Error as e:
+            error('Couldn\'t roll back the journal: {0}'.format(e))
+
+    @staticmethod
+    def __append_rows(connection, args):
+        rows, replaces = args
+        connection.executemany(
+            'INSERT INTO messages (id, event_type, message, state, created_at) VALUES (?, ?, ?, ?, ?)', rows)
+        connection.executemany('UPDATE messages SET state = ? WHERE id = ?',
+                               [(STATE_DONE, entry_id) for entry_id in replaces])
+
+    @staticmethod
+    def __update_state(connection, args):
+        connection.execute('UPDATE messages SET state = ? WHERE id = ?', args)
@@ -0,0 +1,158 @@
+"""
+Provides counters, gauges and histograms exposed in the Prometheus text format
+
+Example usage:
+    with STAGE_SECONDS.time('parse'):
+        payload = parse(body)
+    WEBHOOK_REQUESTS.inc(event_type, 200)
+    REGISTRY.render()
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds. Webhook stages are sub-millisecond, Slack calls take up to the request timeout
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Registry:
+
+    def __init__(self):
+        self.__metrics = []
+
+    def register(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns:
+                (str): All metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self.__metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def _labels(names, values, extra=''):
+    pairs = ['{0}="{1}"'.format(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    type = 'counter'
+
+    def __init__(self, name, documentation, label_names=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.__label_names = tuple(label_names)
+        self.__values = {}
+        self.__lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.__lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.__lock:
+            values = list(self.__values.items())
+        return ['{0}{1} {2}'.format(self.name, _labels(self.__label_names, k), v) for k, v in values]
+
+
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, documentation, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.__value = 0
+        self.__function = None
+        registry.register(self)
+
+    def set(self, value):
+        self.__value = value
+
+    def set_function(self, function):
+        """Reads the value from the function at every scrape."""
+        self.__function = function
+
+    def samples(self):
+        value = self.__function() if self.__function else self.__value
+        return ['{0} {1}'.format(self.name, value)]
+
+
+class Histogram:
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.__label_names = tuple(label_names)
+        self.__buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (the last one is +Inf), sum]
+        self.__values = {}
+        self.__lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.__buckets, value)
+        with self.__lock:
+            series = self.__values.get(label_values)
+            if not series:
+                series = self.__values[label_values] = [[0] * (len(self.__buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observes the duration of the with block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def samples(self):
+        with self.__lock:
+            values = [(k, list(counts), total) for k, (counts, total) in self.__values.items()]
+        lines = []
+        for label_values, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.__buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{0}_bucket{1} {2}'.format(
+                    self.name, _labels(self.__label_names, label_values, 'le="{0}"'.format(bound)), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(self.name, _labels(self.__label_names, label_values), total))
+            lines.append('{0}_count{1} {2}'.format(self.name, _labels(self.__label_names, label_values), cumulative))
+        return lines
+
+
+WEBHOOK_REQUESTS = Counter(
+    'butler_webhook_requests_total', 'Webhook requests by GitLab event type and response status.',
+    ['event', 'status'])
+STAGE_SECONDS = Histogram(
+    'butler_webhook_stage_seconds', 'Latency of the webhook processing stages.', ['stage'])
+USER_DIRECTORY_LOAD_SECONDS = Histogram(
+    'butler_user_directory_load_seconds', 'Latency of loading the users from Mongo.')
+SLACK_REQUEST_SECONDS = Histogram(
+    'butler_slack_request_seconds', 'Latency of single Slack API requests, retries included separately.',
+    ['method'])
+SLACK_ERRORS = Counter(
+    'butler_slack_errors_total', 'Failed Slack API requests by method and error.', ['method', 'error'])
+SLACK_RETRIES = Counter(
+    'butler_slack_retries_total', 'Retried Slack API requests by method.', ['method'])
+QUEUE_DEPTH = Gauge(
+    'butler_delivery_queue_depth', 'Slack messages waiting for delivery.')
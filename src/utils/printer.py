@@ -1,18 +1,50 @@
 """
-Provides utility methods for pretty logging
+Provides utility methods for structured, non-blocking logging
+
+Records are handed to a bounded queue drained by a background thread, so writing to stdout never happens on the
+calling thread. They're formatted as JSON lines, or as colored text on a terminal. Interactive tools call
+write_synchronously() so that records interleave correctly with their prompts. Identical messages are rate
+limited. Levels can be set per module in the logging section of app.config.yaml.
 """
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from consts import *
+from consts.config import add_config_listener
+
+
+__all__ = ['info', 'warning', 'error', 'write_synchronously', 'Color']
+
+# Records waiting to be written. Further records are dropped rather than blocking the caller
+QUEUE_SIZE = 10000
+# How many distinct messages are tracked for rate limiting
+RATE_LIMIT_KEYS = 1000
 
 
 def info(string):
-    print(Color.INFO + 'INFO: ' + Color.ENDC + string)
+    _log(logging.INFO, string)
 
 
 def warning(string):
-    print(Color.WARNING + 'WARNING: ' + Color.ENDC + string)
+    _log(logging.WARNING, string)
 
 
 def error(string):
-    print(Color.ERROR + 'ERROR : ' + Color.ENDC + string)
+    _log(logging.ERROR, string)
+
+
+def _log(level, string):
+    # The module of the caller picks the logger, and with it the configured level
+    logger = logging.getLogger(sys._getframe(2).f_globals.get('__name__', 'butler'))
+    if logger.isEnabledFor(level):
+        logger.log(level, string)
 
 
 class Color:
@@ -21,3 +53,116 @@ class Color:
     ERROR = '\033[91m'
     BOLD = '\033[1m'
     ENDC = '\033[0m'
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'module': record.name,
+                 'message': record.getMessage()}
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    COLORS = {logging.INFO: Color.INFO, logging.WARNING: Color.WARNING, logging.ERROR: Color.ERROR}
+    LABELS = {logging.INFO: 'INFO: ', logging.WARNING: 'WARNING: ', logging.ERROR: 'ERROR : '}
+
+    def format(self, record):
+        text = (self.COLORS.get(record.levelno, '') + self.LABELS.get(record.levelno, record.levelname + ': ') +
+                Color.ENDC + record.getMessage())
+        if getattr(record, 'suppressed', 0):
+            text += ' ({0} similar messages suppressed)'.format(record.suppressed)
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        return text
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets through at most `limit` identical messages per `interval` seconds."""
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.__limit = limit
+        self.__interval = interval
+        # (level, message) -> [window start, count in window, suppressed]
+        self.__windows = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def filter(self, record):
+        if not self.__limit:
+            return True
+        key = (record.levelno, record.msg)
+        now = time.monotonic()
+        with self.__lock:
+            window = self.__windows.get(key)
+            if not window or now - window[0] >= self.__interval:
+                record.suppressed = window[2] if window else 0
+                window = self.__windows[key] = [now, 0, 0]
+            self.__windows.move_to_end(key)
+            while len(self.__windows) > RATE_LIMIT_KEYS:
+                self.__windows.popitem(last=False)
+            window[1] += 1
+            if window[1] > self.__limit:
+                window[2] += 1
+                return False
+            return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+def write_synchronously():
+    """Writes records on the calling thread from now on, e.g. so that they interleave with the prompts of setup.py.
+    Records already queued are written first."""
+    global _handler, _listener
+    with _switch_lock:
+        if not _listener:
+            return
+        _listener.stop()
+        stream = _listener.handlers[0]
+        for log_filter in _handler.filters:
+            stream.addFilter(log_filter)
+        root = logging.getLogger()
+        root.addHandler(stream)
+        root.removeHandler(_handler)
+        _handler, _listener = stream, None
+
+
+def _configure():
+    global _handler, _listener
+    stream = logging.StreamHandler(sys.stdout)
+    use_json = LOG_FORMAT == 'json' or (LOG_FORMAT == 'auto' and not sys.stdout.isatty())
+    stream.setFormatter(JsonFormatter() if use_json else TextFormatter())
+
+    records = queue.Queue(maxsize=QUEUE_SIZE)
+    _handler = DroppingQueueHandler(records)
+    _listener = logging.handlers.QueueListener(records, stream)
+    _listener.start()
+    # Flush what's left when the process exits
+    atexit.register(lambda: _listener and _listener.stop())
+    _handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_INTERVAL))
+
+    logging.getLogger().addHandler(_handler)
+    _set_levels(LOG_LEVEL, LOG_LEVELS)
+
+
+def _set_levels(level, levels):
+    logging.getLogger().setLevel(level.upper())
+    for module, module_level in levels.items():
+        logging.getLogger(module).setLevel(str(module_level).upper())
+
+
+_handler = _listener = None
+_switch_lock = threading.Lock()
+_configure()
+add_config_listener(lambda config: _set_levels(config.log_level, config.log_levels))
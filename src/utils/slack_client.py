@@ -0,0 +1,227 @@
+"""
+Provides a pooled, rate limit aware client for the Slack Web API
+
+Example usage:
+    client = SlackClient(SLACK_AUTH_HEADER)
+    result = client.post_message(template.render('U123', title='Hello!'))
+    if not result.ok:
+        warning('Slack returned {0}'.format(result.error))
+"""
+import random
+import threading
+import time
+from collections import namedtuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from consts import *
+from .metrics import SLACK_ERRORS, SLACK_REQUEST_SECONDS, SLACK_RETRIES
+
+
+# Outcome of a single Slack API call, after all retries
+SlackResult = namedtuple('SlackResult', ['ok', 'status_code', 'error', 'attempts', 'data'])
+
+# Slack errors that are worth retrying
+RETRYABLE_ERRORS = {'ratelimited', 'internal_error', 'fatal_error', 'service_unavailable', 'request_timeout'}
+
+JSON_HEADER = {'Content-type': 'application/json; charset=utf-8'}
+
+# Error of a message not sent because its channel has used up its rate, see post_message()
+CHANNEL_BUSY = 'channel_busy'
+
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity):
+        """Args:
+            :param rate:     (float): Tokens added per second.
+            :param capacity: (int):   Maximum number of tokens, i.e. the allowed burst.
+        """
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available."""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """Takes a token if one is available.
+
+            Returns:
+                (float): 0 if a token was taken, otherwise the number of seconds until one is available.
+        """
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            if self.__tokens >= 1:
+                self.__tokens -= 1
+                return 0
+            return (1 - self.__tokens) / self.__rate
+
+
+class SlackClient:
+
+    def __init__(self, auth_header, timeout=REQUEST_TIMEOUT, max_retries=SLACK_MAX_RETRIES,
+                 backoff=SLACK_RETRY_BACKOFF, pool_size=10, cache=None):
+        """Args:
+            :param auth_header: (dict):  Slack authorization header.
+            :param timeout:     (float): Timeout of a single HTTP request, in seconds.
+            :param max_retries: (int):   How many times a failed call is retried.
+            :param backoff:     (float): Base of the exponential backoff between retries, in seconds.
+            :param pool_size:   (int):   Number of keep-alive connections to slack.com.
+            :param cache:       (HttpCache): Cache of users.list pages, None to always fetch them.
+        """
+        self.__cache = cache
+        self.configure(auth_header, timeout, max_retries, backoff)
+        self.__session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.__session.mount('https://', adapter)
+        self.__session.mount('http://', adapter)
+        # chat.postMessage allows about one message per second per channel, everything else is tiered per method
+        self.__channel_buckets = {}
+        self.__method_buckets = {
+            SLACK_GET_USER_LIST_URL: TokenBucket(*SLACK_TIER_2),
+        }
+        self.__lock = threading.Lock()
+
+    def configure(self, auth_header, timeout, max_retries, backoff):
+        """Applies new settings, e.g. a rotated token. Calls in progress finish with the old ones."""
+        # One tuple, so that calls read a consistent set without locking
+        self.__settings = (dict(auth_header), timeout, max_retries, backoff)
+
+    def post_message(self, message, wait=True, attempt=1):
+        """Posts a message via chat.postMessage.
+
+            Args:
+                :param message: (SlackMessage): Rendered message.
+                :param wait:    (bool):         Whether to wait for the channel's rate and between retries.
+                :param attempt: (int):          Number of this attempt, when `wait` is False and the caller retries.
+
+            Returns:
+                (SlackResult): Outcome of the call. If `wait` is False, only one attempt is made. If the message should
+                               be retried, data['retry_after'] says in how many seconds: error is CHANNEL_BUSY if the
+                               channel has used up its rate, otherwise the retryable error Slack returned.
+        """
+        bucket = self.__get_channel_bucket(message.channel)
+        if not wait:
+            retry_after = bucket.try_acquire()
+            if retry_after:
+                return SlackResult(False, None, CHANNEL_BUSY, attempt - 1, {'retry_after': retry_after})
+        return self.__call('POST', SLACK_POST_MESSAGE_URL, bucket, data=message.body, json_body=True,
+                           wait=wait, first_attempt=attempt)
+
+    def list_users(self, **params):
+        """Fetches a page of workspace members via users.list.
+
+            Returns:
+                (SlackResult): Outcome of the call, members are in result.data['members'].
+        """
+        return self.__call('GET', SLACK_GET_USER_LIST_URL, self.__method_buckets[SLACK_GET_USER_LIST_URL],
+                           params=params)
+
+    def list_users_pages(self, limit=200):
+        """Fetches all workspace members page by page, following the cursor. Stops after a failed page.
+
+            Args:
+                :param limit: (int): Members per page. Slack recommends no more than 200.
+
+            Returns:
+                (generator): SlackResult of every page, members are in result.data['members'].
+        """
+        params = {'limit': limit}
+        while True:
+            result = self.list_users(**params)
+            yield result
+            cursor = result.data.get('response_metadata', {}).get('next_cursor') if result.ok else None
+            if not cursor:
+                return
+            params['cursor'] = cursor
+
+    def __get_channel_bucket(self, channel):
+        with self.__lock:
+            bucket = self.__channel_buckets.get(channel)
+            if not bucket:
+                bucket = self.__channel_buckets[channel] = TokenBucket(*SLACK_POST_MESSAGE_RATE)
+            return bucket
+
+    def __call(self, method, url, bucket, json_body=False, wait=True, first_attempt=1, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        status_code = None
+        err = None
+        data = {}
+        auth_header, timeout, max_retries, backoff = self.__settings
+        headers = {**auth_header, **JSON_HEADER} if json_body else auth_header
+
+        # At least one attempt, even if max_retries was lowered while the message waited for a retry
+        for attempt in range(first_attempt, max(first_attempt, max_retries + 1) + 1):
+            # Without waiting, the caller has taken the token
+            if wait:
+                bucket.acquire()
+            retry_after = 0
+            try:
+                with SLACK_REQUEST_SECONDS.time(api_method):
+                    response = self.__send(method, url, headers, timeout, **kwargs)
+            except requests.RequestException as e:
+                err = type(e).__name__
+            else:
+                status_code = response.status_code
+                try:
+                    data = response.json()
+                except ValueError:
+                    data = {}
+                if status_code == requests.codes.too_many_requests:
+                    err = 'ratelimited'
+                    retry_after = self.__get_retry_after(response)
+                elif status_code >= 500:
+                    err = 'http_{0}'.format(status_code)
+                elif data.get('ok'):
+                    return SlackResult(True, status_code, None, attempt, data)
+                else:
+                    err = data.get('error', 'http_{0}'.format(status_code))
+                    if err not in RETRYABLE_ERRORS:
+                        SLACK_ERRORS.inc(api_method, err)
+                        break
+                    retry_after = self.__get_retry_after(response)
+
+            SLACK_ERRORS.inc(api_method, err)
+            if attempt <= max_retries:
+                SLACK_RETRIES.inc(api_method)
+                # Full jitter, but never sooner than Slack asked us to
+                delay = max(retry_after, random.uniform(0, backoff * 2 ** (attempt - 1)))
+                if not wait:
+                    return SlackResult(False, status_code, err, attempt, {'retry_after': delay})
+                time.sleep(delay)
+
+        return SlackResult(False, status_code, err, attempt, data)
+
+    def __send(self, method, url, headers, timeout, **kwargs):
+        if method != 'GET' or not self.__cache:
+            return self.__session.request(method, url, headers=headers, timeout=timeout, **kwargs)
+        # Only successful calls are worth keeping, Slack reports errors with a 200 too
+        return self.__cache.fetch(
+            lambda validators: self.__session.request(method, url, headers={**headers, **validators},
+                                                      timeout=timeout, **kwargs),
+            url, params=kwargs.get('params'), scope=headers, cacheable=lambda r: self.__is_ok(r))
+
+    @staticmethod
+    def __is_ok(response):
+        try:
+            return bool(response.json().get('ok'))
+        except ValueError:
+            return False
+
+    @staticmethod
+    def __get_retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return 0
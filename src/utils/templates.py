@@ -0,0 +1,163 @@
+"""
+Provides precompiled templates for Slack messages
+
+A template is the attachment of a chat.postMessage call. String values may contain {placeholders} that are
+filled in when rendering; everything else is serialized once, when the template is compiled. Rendering
+produces ready-to-send JSON bytes, with long values truncated to Slack's limits and members whose value
+renders empty left out.
+
+Example usage:
+    templates = compile_templates({'hello': {'pretext': 'Hi {name}!', 'text': '{text}'}})
+    message = templates['hello'].render('U123', name='Bob', text='')
+    message.body  # b'{"channel":"U123","as_user":true,"attachments":[{"pretext":"Hi Bob!"}]}'
+"""
+import json
+import string
+from collections import namedtuple
+
+from consts import *
+
+
+# A rendered message. `values` are the placeholder values it was rendered with, None for replayed messages.
+SlackMessage = namedtuple('SlackMessage', ['channel', 'body', 'values'])
+
+# Maximum length of attachment members, by member name. See https://api.slack.com/docs/message-attachments
+FIELD_LIMITS = {
+    'pretext': SLACK_MAX_TEXT_LENGTH,
+    'text': SLACK_MAX_TEXT_LENGTH,
+    'title': 256,
+    'value': 2000,
+}
+ELLIPSIS = '…'
+
+_formatter = string.Formatter()
+
+
+class Template:
+
+    def __init__(self, attachment, as_user=True, limits=FIELD_LIMITS):
+        """Args:
+            :param attachment: (dict): Attachment spec, strings may contain {placeholders}.
+            :param as_user:    (bool): Whether the message is posted as the authenticated user.
+            :param limits:     (dict): Maximum length of attachment members, by member name.
+        """
+        self.__render = _compile({'channel': '{channel}', 'as_user': as_user, 'attachments': [attachment]}, limits)
+
+    def render(self, channel, **values):
+        """Renders the message.
+
+            Args:
+                :param channel: (str): Slack channel or user id.
+                :param values:  (dict): Placeholder values, missing or None values render empty.
+
+            Returns:
+                (SlackMessage): The message with its JSON body.
+        """
+        values['channel'] = channel
+        context = _Values((k, '' if v is None else v) for k, v in values.items())
+        return SlackMessage(channel, self.__render(context).encode('utf-8'), values)
+
+
+def compile_templates(specs, max_text_length=SLACK_MAX_TEXT_LENGTH):
+    """Compiles templates by name.
+
+        Args:
+            :param specs:           (dict): Attachment specs by template name.
+            :param max_text_length: (int):  Maximum length of the pretext and text members.
+
+        Returns:
+            (dict): Templates by name.
+    """
+    limits = {**FIELD_LIMITS, 'pretext': max_text_length, 'text': max_text_length}
+    return {name: Template(spec, limits=limits) for name, spec in specs.items()}
+
+
+class _Values(dict):
+
+    def __missing__(self, key):
+        return ''
+
+
+def _compile(node, limits, name=None):
+    """Returns the JSON text of static nodes, or a function rendering it from placeholder values."""
+    if isinstance(node, dict):
+        members = []
+        for key, value in node.items():
+            prefix = json.dumps(key, ensure_ascii=False) + ':'
+            compiled = _compile(value, limits, key)
+            if isinstance(compiled, str):
+                members.append(prefix + compiled)
+            elif isinstance(value, str):
+                members.append(_omit_empty(prefix, compiled))
+            else:
+                members.append(_prefixed(prefix, compiled))
+        if all(isinstance(m, str) for m in members):
+            return '{' + ','.join(members) + '}'
+        return _joined('{', members, '}')
+
+    if isinstance(node, list):
+        items = [_compile(item, limits, name) for item in node]
+        items = [_or_empty(i) if isinstance(item, str) and not isinstance(i, str) else i
+                 for item, i in zip(node, items)]
+        if all(isinstance(i, str) for i in items):
+            return '[' + ','.join(items) + ']'
+        return _joined('[', items, ']')
+
+    if isinstance(node, str) and _placeholders(node):
+        return _string(node, limits.get(name))
+
+    if isinstance(node, str):
+        # Unescapes {{ and }}
+        node = node.format()
+    return json.dumps(node, ensure_ascii=False)
+
+
+def _placeholders(fmt):
+    """Returns the placeholder names of a format string. Raises ValueError for anything but plain {names}:
+    positional, attribute, index, conversion and format spec fields can't be rendered from string values."""
+    names = []
+    for _, field, format_spec, conversion in _formatter.parse(fmt):
+        if field is None:
+            continue
+        if not field.isidentifier() or format_spec or conversion:
+            raise ValueError('Unsupported placeholder {{{0}}} in template string {1!r}, only {{name}} is allowed'
+                             .format(field + ('!' + conversion if conversion else '') +
+                                     (':' + format_spec if format_spec else ''), fmt))
+        names.append(field)
+    return names
+
+
+def _string(fmt, limit):
+    def render(values):
+        value = fmt.format_map(values)
+        if limit and len(value) > limit:
+            value = value[:limit - len(ELLIPSIS)] + ELLIPSIS
+        return json.dumps(value, ensure_ascii=False) if value else None
+    return render
+
+
+def _omit_empty(prefix, render_value):
+    def render(values):
+        value = render_value(values)
+        return prefix + value if value is not None else None
+    return render
+
+
+def _prefixed(prefix, render_value):
+    def render(values):
+        return prefix + render_value(values)
+    return render
+
+
+def _or_empty(render_value):
+    def render(values):
+        value = render_value(values)
+        return value if value is not None else '""'
+    return render
+
+
+def _joined(opening, parts, closing):
+    def render(values):
+        rendered = (p if isinstance(p, str) else p(values) for p in parts)
+        return opening + ','.join(r for r in rendered if r is not None) + closing
+    return render
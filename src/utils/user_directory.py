@@ -0,0 +1,109 @@
+"""
+Provides an in-memory, hash indexed copy of the users collection
+
+The users collection is small and changes only when setup.py runs, so the webhook server keeps it in memory
+and resolves all parties of an event without touching the database. setup.py bumps a version stamp after every
+write, the directory polls that stamp and reloads when it changes.
+"""
+import threading
+import time
+import uuid
+
+from pymongo.errors import PyMongoError
+
+from consts import *
+from .metrics import USER_DIRECTORY_LOAD_SECONDS
+from .printer import error, info
+
+
+def stamp_users_version(meta_collection):
+    """Marks the users collection as changed so that running directories reload it.
+
+        Args:
+            :param meta_collection: (Collection): Collection holding the version stamp.
+    """
+    meta_collection.update_one({'_id': KEY_USERS_VERSION},
+                               {'$set': {'version': uuid.uuid4().hex, 'updated_at': time.time()}}, upsert=True)
+
+
+class UserDirectory:
+
+    def __init__(self, user_collection=None, meta_collection=None, refresh_interval=USER_DIRECTORY_REFRESH):
+        """Args:
+            :param user_collection:  (Collection): Collection with the users.
+            :param meta_collection:  (Collection): Collection with the version stamp.
+            :param refresh_interval: (float):      How often the version stamp is checked, in seconds.
+
+        Without collections the directory is filled by the caller via replace(), e.g. by an async loader.
+        """
+        self.__user_collection = user_collection
+        self.__meta_collection = meta_collection
+        self.__refresh_interval = refresh_interval
+        self.__version = None
+        # (by repo id, by gitlab username, by gitlab user id), swapped as a whole on reload
+        self.__indexes = ({}, {}, {})
+
+    def start(self):
+        """Loads the users and starts watching the version stamp in the background."""
+        self.load()
+        threading.Thread(target=self.__watch, name='user-directory', daemon=True).start()
+
+    def load(self):
+        """Reloads all users from the database and rebuilds the indexes."""
+        with USER_DIRECTORY_LOAD_SECONDS.time():
+            version = self.__get_version()
+            users = list(self.__user_collection.find({}))
+        self.replace(users, version)
+
+    def replace(self, users, version=None):
+        """Rebuilds the indexes from the given users. Lookups see either the old or the new users, never a mix.
+
+            Args:
+                :param users:   ([dict]): All users.
+                :param version: (str):    Version stamp the users were loaded at.
+        """
+        by_repo_id, by_uname, by_user_id = {}, {}, {}
+        for user in users:
+            # First match wins, same as find_one
+            if user.get(KEY_GITLAB_REPO_ID) is not None:
+                by_repo_id.setdefault(user[KEY_GITLAB_REPO_ID], user)
+            if user.get(KEY_GITLAB_UNAME) is not None:
+                by_uname.setdefault(user[KEY_GITLAB_UNAME], user)
+            if user.get(KEY_GITLAB_USER_ID) is not None:
+                by_user_id.setdefault(user[KEY_GITLAB_USER_ID], user)
+        self.__indexes = (by_repo_id, by_uname, by_user_id)
+        self.__version = version
+        info('Loaded {0} users into the directory.'.format(len(users)))
+
+    @property
+    def version(self):
+        return self.__version
+
+    def refresh(self):
+        """Reloads the users if the version stamp has changed since the last load."""
+        if self.__get_version() != self.__version:
+            self.load()
+
+    def find_by_repo_id(self, repo_id):
+        return self.__indexes[0].get(repo_id)
+
+    def find_by_gitlab_uname(self, uname):
+        return self.__indexes[1].get(uname)
+
+    def find_by_gitlab_user_id(self, user_id):
+        return self.__indexes[2].get(user_id)
+
+    def __len__(self):
+        return len(self.__indexes[1])
+
+    def __get_version(self):
+        stamp = self.__meta_collection.find_one({'_id': KEY_USERS_VERSION})
+        return stamp.get('version') if stamp else None
+
+    def __watch(self):
+        while True:
+            time.sleep(self.__refresh_interval)
+            try:
+                self.refresh()
+            except PyMongoError as e:
+                error('Couldn\'t refresh the user directory, serving cached users. {0}'.format(e))